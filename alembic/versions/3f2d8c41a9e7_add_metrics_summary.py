@@ -0,0 +1,41 @@
+"""add metrics summary
+
+Revision ID: 3f2d8c41a9e7
+Revises: 625ad9a0b291
+Create Date: 2026-10-18 10:12:31.418265
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2d8c41a9e7'
+down_revision = '625ad9a0b291'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Narrow table with the per-record values needed for the basic stats
+    # (and citation counts), kept up to date by refresh_metrics_summary
+    op.create_table('metrics_summary',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('bibcode', sa.String(), nullable=False),
+        sa.Column('refereed', sa.Boolean(), server_default=sa.false()),
+        sa.Column('author_num', sa.Integer(), server_default=sa.text("1::integer")),
+        sa.Column('citation_num', sa.Integer(), server_default=sa.text("0::integer")),
+        sa.Column('refereed_citation_num', sa.Integer(), server_default=sa.text("0::integer")),
+        sa.Column('reads_total', sa.BigInteger(), server_default=sa.text("0::bigint")),
+        sa.Column('reads_recent', sa.Integer(), server_default=sa.text("0::integer")),
+        sa.Column('reads_length', sa.Integer(), server_default=sa.text("0::integer")),
+        sa.Column('downloads_total', sa.BigInteger(), server_default=sa.text("0::bigint")),
+        sa.Column('downloads_recent', sa.Integer(), server_default=sa.text("0::integer")),
+        sa.Column('downloads_length', sa.Integer(), server_default=sa.text("0::integer")),
+        sa.Column('modtime', sa.DateTime()),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_metrics_summary_modtime', 'metrics_summary', ['modtime'])
+
+
+def downgrade():
+    op.drop_index('ix_metrics_summary_modtime', table_name='metrics_summary')
+    op.drop_table('metrics_summary')
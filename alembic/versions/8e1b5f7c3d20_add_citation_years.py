@@ -0,0 +1,80 @@
+"""add citation years
+
+Revision ID: 8e1b5f7c3d20
+Revises: 3f2d8c41a9e7
+Create Date: 2026-10-18 11:02:47.902113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e1b5f7c3d20'
+down_revision = '3f2d8c41a9e7'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    # The number of citations per year (starting at citation_years_start),
+    # from refereed and non-refereed citing papers. These are classified the
+    # same way as in the citation histograms: for refereed records the
+    # non-refereed citations are the distinct citations not in
+    # refereed_citations, for non-refereed records both are taken from
+    # citations. Citations that do not start with a year are not counted.
+    # The counts are maintained by a trigger, so that they are computed
+    # whenever a record is ingested or updated.
+    op.add_column('metrics', sa.Column('citation_years_start', sa.Integer()))
+    op.add_column('metrics', sa.Column('refereed_citation_years', postgresql.ARRAY(sa.Integer())))
+    op.add_column('metrics', sa.Column('nonrefereed_citation_years', postgresql.ARRAY(sa.Integer())))
+    op.execute('CREATE OR REPLACE FUNCTION set_citation_years() RETURNS TRIGGER AS\n'\
+                   '$BODY$\n'\
+                   'DECLARE\n'\
+                   '\t ref_years integer[];\n'\
+                   '\t nonref_years integer[];\n'\
+                   '\t first_year integer;\n'\
+                   '\t last_year integer;\n'\
+                   'BEGIN\n'\
+                   '\t IF NEW.refereed THEN\n'\
+                   '\t\t SELECT array_agg(substr(c, 1, 4)::integer) INTO ref_years\n'\
+                   '\t\t FROM unnest(NEW.refereed_citations) AS c\n'\
+                   '\t\t WHERE c ~ \'^[0-9]{4}\';\n'\
+                   '\t\t SELECT array_agg(substr(c, 1, 4)::integer) INTO nonref_years\n'\
+                   '\t\t FROM (SELECT DISTINCT c FROM unnest(NEW.citations) AS c\n'\
+                   '\t\t       WHERE NOT c = ANY (coalesce(NEW.refereed_citations, \'{}\'))) AS d\n'\
+                   '\t\t WHERE c ~ \'^[0-9]{4}\';\n'\
+                   '\t ELSE\n'\
+                   '\t\t SELECT array_agg(substr(c, 1, 4)::integer) INTO ref_years\n'\
+                   '\t\t FROM unnest(NEW.citations) AS c\n'\
+                   '\t\t WHERE c = ANY (coalesce(NEW.refereed_citations, \'{}\'))\n'\
+                   '\t\t AND c ~ \'^[0-9]{4}\';\n'\
+                   '\t\t SELECT array_agg(substr(c, 1, 4)::integer) INTO nonref_years\n'\
+                   '\t\t FROM unnest(NEW.citations) AS c\n'\
+                   '\t\t WHERE NOT c = ANY (coalesce(NEW.refereed_citations, \'{}\'))\n'\
+                   '\t\t AND c ~ \'^[0-9]{4}\';\n'\
+                   '\t END IF;\n'\
+                   '\t SELECT min(y), max(y) INTO first_year, last_year\n'\
+                   '\t FROM unnest(coalesce(ref_years, \'{}\') || coalesce(nonref_years, \'{}\')) AS y;\n'\
+                   '\t NEW.citation_years_start := first_year;\n'\
+                   '\t NEW.refereed_citation_years := ARRAY(\n'\
+                   '\t\t SELECT count(r.y) FROM generate_series(first_year, last_year) AS g(y)\n'\
+                   '\t\t LEFT JOIN unnest(ref_years) AS r(y) ON r.y = g.y GROUP BY g.y ORDER BY g.y);\n'\
+                   '\t NEW.nonrefereed_citation_years := ARRAY(\n'\
+                   '\t\t SELECT count(r.y) FROM generate_series(first_year, last_year) AS g(y)\n'\
+                   '\t\t LEFT JOIN unnest(nonref_years) AS r(y) ON r.y = g.y GROUP BY g.y ORDER BY g.y);\n'\
+                   '\t RETURN NEW;\n'\
+                   'END\n'\
+                   '$BODY$ LANGUAGE PLPGSQL;\n'\
+                   'CREATE TRIGGER set_citation_years_trigger\n'\
+                   'BEFORE INSERT OR UPDATE OF citations, refereed_citations, refereed ON metrics\n'\
+                   'FOR EACH ROW EXECUTE PROCEDURE set_citation_years();\n')
+    # Compute the counts for the existing records
+    op.execute('UPDATE metrics SET citations = citations')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER IF EXISTS set_citation_years_trigger ON metrics')
+    op.execute('DROP FUNCTION IF EXISTS set_citation_years()')
+    op.drop_column('metrics', 'nonrefereed_citation_years')
+    op.drop_column('metrics', 'refereed_citation_years')
+    op.drop_column('metrics', 'citation_years_start')
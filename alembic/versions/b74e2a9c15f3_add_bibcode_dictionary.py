@@ -0,0 +1,67 @@
+"""add bibcode dictionary
+
+Revision ID: b74e2a9c15f3
+Revises: 8e1b5f7c3d20
+Create Date: 2026-10-18 12:21:05.337519
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b74e2a9c15f3'
+down_revision = '8e1b5f7c3d20'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    # Every citing bibcode gets an int64 identifier, with the publication
+    # year in the bits above bit 40 (see metrics_service/codec.py), and the
+    # citation arrays are also stored as arrays of these identifiers. The
+    # dictionary and the arrays are maintained by a trigger. Only bibcodes
+    # that are not in the dictionary yet take a value of the sequence, which
+    # stops at 2^40 - 1 so that it never runs into the year bits.
+    op.execute('CREATE SEQUENCE bibcode_dictionary_id_seq MAXVALUE 1099511627775')
+    op.create_table('bibcode_dictionary',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('bibcode', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('bibcode')
+    )
+    op.add_column('metrics', sa.Column('citation_ids', postgresql.ARRAY(sa.BigInteger())))
+    op.add_column('metrics', sa.Column('refereed_citation_ids', postgresql.ARRAY(sa.BigInteger())))
+    op.execute('CREATE OR REPLACE FUNCTION set_citation_ids() RETURNS TRIGGER AS\n'\
+                   '$BODY$\n'\
+                   'BEGIN\n'\
+                   '\t INSERT INTO bibcode_dictionary (id, bibcode)\n'\
+                   '\t SELECT (CASE WHEN substr(c, 1, 4) ~ \'^[0-9]{4}$\'\n'\
+                   '\t              THEN substr(c, 1, 4)::bigint ELSE 0 END << 40)\n'\
+                   '\t        | nextval(\'bibcode_dictionary_id_seq\'), c\n'\
+                   '\t FROM (SELECT DISTINCT c FROM unnest(coalesce(NEW.citations, \'{}\') ||\n'\
+                   '\t       coalesce(NEW.refereed_citations, \'{}\')) AS c) AS d\n'\
+                   '\t WHERE NOT EXISTS (SELECT 1 FROM bibcode_dictionary x WHERE x.bibcode = d.c)\n'\
+                   '\t ON CONFLICT (bibcode) DO NOTHING;\n'\
+                   '\t NEW.citation_ids := ARRAY(\n'\
+                   '\t\t SELECT d.id FROM unnest(NEW.citations) WITH ORDINALITY AS c(bibcode, n)\n'\
+                   '\t\t JOIN bibcode_dictionary d ON d.bibcode = c.bibcode ORDER BY c.n);\n'\
+                   '\t NEW.refereed_citation_ids := ARRAY(\n'\
+                   '\t\t SELECT d.id FROM unnest(NEW.refereed_citations) WITH ORDINALITY AS c(bibcode, n)\n'\
+                   '\t\t JOIN bibcode_dictionary d ON d.bibcode = c.bibcode ORDER BY c.n);\n'\
+                   '\t RETURN NEW;\n'\
+                   'END\n'\
+                   '$BODY$ LANGUAGE PLPGSQL;\n'\
+                   'CREATE TRIGGER set_citation_ids_trigger\n'\
+                   'BEFORE INSERT OR UPDATE OF citations, refereed_citations ON metrics\n'\
+                   'FOR EACH ROW EXECUTE PROCEDURE set_citation_ids();\n')
+    # Encode the citations of the existing records
+    op.execute('UPDATE metrics SET citations = citations')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER IF EXISTS set_citation_ids_trigger ON metrics')
+    op.execute('DROP FUNCTION IF EXISTS set_citation_ids()')
+    op.drop_column('metrics', 'refereed_citation_ids')
+    op.drop_column('metrics', 'citation_ids')
+    op.drop_table('bibcode_dictionary')
+    op.execute('DROP SEQUENCE IF EXISTS bibcode_dictionary_id_seq')
@@ -0,0 +1,71 @@
+"""add tori arrays
+
+Revision ID: c5d1f08e6a42
+Revises: b74e2a9c15f3
+Create Date: 2026-10-18 13:04:41.902215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5d1f08e6a42'
+down_revision = 'b74e2a9c15f3'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    # The entries of rn_citation_data as parallel arrays: the bibcode
+    # identifier (see the add_bibcode_dictionary migration), publication year
+    # (0 when missing) and year of the citing paper, and the Tori weight
+    # (auth_norm * ref_norm). The arrays are maintained by a trigger.
+    op.add_column('metrics', sa.Column('tori_ids', postgresql.ARRAY(sa.BigInteger())))
+    op.add_column('metrics', sa.Column('tori_pubyears', postgresql.ARRAY(sa.Integer())))
+    op.add_column('metrics', sa.Column('tori_cityears', postgresql.ARRAY(sa.Integer())))
+    op.add_column('metrics', sa.Column('tori_weights', postgresql.ARRAY(postgresql.DOUBLE_PRECISION())))
+    op.execute('CREATE OR REPLACE FUNCTION set_tori_arrays() RETURNS TRIGGER AS\n'\
+                   '$BODY$\n'\
+                   'BEGIN\n'\
+                   '\t IF NEW.rn_citation_data IS NULL OR\n'\
+                   '\t    json_typeof(NEW.rn_citation_data) <> \'array\' THEN\n'\
+                   '\t\t NEW.tori_ids := \'{}\';\n'\
+                   '\t\t NEW.tori_pubyears := \'{}\';\n'\
+                   '\t\t NEW.tori_cityears := \'{}\';\n'\
+                   '\t\t NEW.tori_weights := \'{}\';\n'\
+                   '\t\t RETURN NEW;\n'\
+                   '\t END IF;\n'\
+                   '\t INSERT INTO bibcode_dictionary (id, bibcode)\n'\
+                   '\t SELECT (CASE WHEN substr(b, 1, 4) ~ \'^[0-9]{4}$\'\n'\
+                   '\t              THEN substr(b, 1, 4)::bigint ELSE 0 END << 40)\n'\
+                   '\t        | nextval(\'bibcode_dictionary_id_seq\'), b\n'\
+                   '\t FROM (SELECT DISTINCT e->>\'bibcode\' AS b\n'\
+                   '\t       FROM json_array_elements(NEW.rn_citation_data) AS e) AS d\n'\
+                   '\t WHERE b IS NOT NULL AND\n'\
+                   '\t       NOT EXISTS (SELECT 1 FROM bibcode_dictionary x WHERE x.bibcode = d.b)\n'\
+                   '\t ON CONFLICT (bibcode) DO NOTHING;\n'\
+                   '\t SELECT coalesce(array_agg(d.id ORDER BY e.n), \'{}\'),\n'\
+                   '\t        coalesce(array_agg(coalesce((e.r->>\'pubyear\')::integer, 0) ORDER BY e.n), \'{}\'),\n'\
+                   '\t        coalesce(array_agg((e.r->>\'cityear\')::integer ORDER BY e.n), \'{}\'),\n'\
+                   '\t        coalesce(array_agg((e.r->>\'auth_norm\')::float8 *\n'\
+                   '\t                           (e.r->>\'ref_norm\')::float8 ORDER BY e.n), \'{}\')\n'\
+                   '\t INTO NEW.tori_ids, NEW.tori_pubyears, NEW.tori_cityears, NEW.tori_weights\n'\
+                   '\t FROM json_array_elements(NEW.rn_citation_data) WITH ORDINALITY AS e(r, n)\n'\
+                   '\t LEFT JOIN bibcode_dictionary d ON d.bibcode = e.r->>\'bibcode\';\n'\
+                   '\t RETURN NEW;\n'\
+                   'END\n'\
+                   '$BODY$ LANGUAGE PLPGSQL;\n'\
+                   'CREATE TRIGGER set_tori_arrays_trigger\n'\
+                   'BEFORE INSERT OR UPDATE OF rn_citation_data ON metrics\n'\
+                   'FOR EACH ROW EXECUTE PROCEDURE set_tori_arrays();\n')
+    # Fill in the arrays of the existing records
+    op.execute('UPDATE metrics SET rn_citation_data = rn_citation_data')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER IF EXISTS set_tori_arrays_trigger ON metrics')
+    op.execute('DROP FUNCTION IF EXISTS set_tori_arrays()')
+    op.drop_column('metrics', 'tori_weights')
+    op.drop_column('metrics', 'tori_cityears')
+    op.drop_column('metrics', 'tori_pubyears')
+    op.drop_column('metrics', 'tori_ids')
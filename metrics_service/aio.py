@@ -0,0 +1,107 @@
+'''
+Asyncio data layer
+
+With METRICS_ASYNC_DB, the metrics queries are executed with asyncpg
+instead of psycopg2. Every worker process runs an event loop in a
+background thread, with one pool of asyncpg connections. The functions in
+models.py submit their queries to this loop and wait for the results, so
+that they keep their signatures, while all request threads of the process
+share the connections and the chunks of large requests are retrieved
+concurrently on the loop (rather than by threads with a connection each).
+Queries are prepared by asyncpg (once per connection).
+
+This module needs Python 3 (and asyncpg), so it is only imported when the
+asyncio data layer is enabled.
+'''
+import asyncio
+import json
+import re
+import threading
+from .models import get_row_type
+from .models import positional_parameters
+
+
+def dsn_from_uri(uri):
+    # asyncpg takes libpq style URIs, without the SQLAlchemy driver name
+    return re.sub(r'^postgresql\+\w+://', 'postgresql://', uri)
+
+
+def positional(query, params):
+    """
+    Convert a query with named parameters (:name) to one with positional
+    parameters ($n), and return it with the list of parameter values
+    """
+    statement, names = positional_parameters(query, params)
+    return statement, [params[name] for name in names]
+
+
+def make_rows(records):
+    # Records as named tuples, like the rows returned by SQLAlchemy
+    if not records:
+        return []
+    row_type = get_row_type(list(records[0].keys()))
+    return [row_type(*r.values()) for r in records]
+
+
+async def init_connection(connection):
+    # Decode json columns (rn_citation_data) like psycopg2 does
+    await connection.set_type_codec('json', encoder=json.dumps,
+                                    decoder=json.loads, schema='pg_catalog')
+
+
+class AsyncDatabase(object):
+
+    def __init__(self, uri, pool_size=10):
+        self.dsn = dsn_from_uri(uri)
+        self.pool_size = pool_size
+        self.loop = None
+        self.pool = None
+        self.pool_lock = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever)
+                thread.daemon = True
+                thread.start()
+                self.loop = loop
+        return self.loop
+
+    async def get_pool(self):
+        if self.pool is None:
+            if self.pool_lock is None:
+                self.pool_lock = asyncio.Lock()
+            async with self.pool_lock:
+                if self.pool is None:
+                    import asyncpg
+                    self.pool = await asyncpg.create_pool(
+                        self.dsn, min_size=1, max_size=self.pool_size,
+                        init=init_connection)
+        return self.pool
+
+    async def fetch(self, query, params):
+        statement, args = positional(query, params)
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            records = await connection.fetch(statement, *args)
+        return make_rows(records)
+
+    async def fetch_all(self, queries):
+        return await asyncio.gather(*[self.fetch(query, params)
+                                      for query, params in queries])
+
+    def run(self, coroutine):
+        # Called from the request threads: wait for the coroutine on the loop
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start()).result()
+
+    def execute(self, query, params):
+        return self.run(self.fetch(query, params))
+
+    def execute_many(self, queries):
+        """
+        Execute the (query, params) pairs concurrently and return their
+        results in the same order
+        """
+        return self.run(self.fetch_all(queries))
@@ -5,6 +5,10 @@ from .views import Metrics, PubMetrics, DetailMetrics
 from flask_restful import Api
 from flask_discoverer import Discoverer
 from adsmutils import ADSFlask
+from .cache import RowCache, SharedRowCache, ResultCache
+from .snapshot import SnapshotStore
+from .index import BibcodeIndex
+from .replicas import ReplicaRouter
 
 
 def create_app(**config):
@@ -27,6 +31,56 @@ def create_app(**config):
 
     discoverer = Discoverer(app)
 
+    # Asyncio data layer (see models.execute_SQL_query)
+    if app.config.get('METRICS_ASYNC_DB'):
+        from .aio import AsyncDatabase
+        app.aio = AsyncDatabase(app.config['SQLALCHEMY_DATABASE_URI'],
+                                app.config.get('METRICS_ASYNC_POOL_SIZE', 10))
+    # Read replicas for the metrics queries (see models.execute_SQL_query)
+    if app.config.get('METRICS_READ_REPLICAS'):
+        app.replicas = ReplicaRouter(app.config['METRICS_READ_REPLICAS'],
+                                     app.config.get('METRICS_HEDGE_DELAY'),
+                                     app.config.get('METRICS_REPLICA_THREADS', 16),
+                                     app.config.get('METRICS_REPLICA_POOL_SIZE', 5))
+    # The queries of the asyncio data layer and the read replicas do not
+    # run in the transactions of the application database, so they cannot
+    # share the transaction (and snapshot) of a request
+    if app.config.get('METRICS_REQUEST_SESSION') and \
+       (app.config.get('METRICS_ASYNC_DB') or
+        app.config.get('METRICS_READ_REPLICAS')):
+        app.logger.warning('METRICS_REQUEST_SESSION is disabled, because it '
+                           'cannot be combined with METRICS_ASYNC_DB or '
+                           'METRICS_READ_REPLICAS')
+        app.config['METRICS_REQUEST_SESSION'] = False
+    # The records from the row cache are compact already
+    if app.config.get('METRICS_COMPACT_RECORDS') and \
+       (app.config.get('METRICS_SHARED_CACHE') or
+        app.config.get('METRICS_ROW_CACHE_SIZE')):
+        app.logger.warning('METRICS_COMPACT_RECORDS is disabled, because it '
+                           'cannot be combined with the row cache')
+        app.config['METRICS_COMPACT_RECORDS'] = False
+    # Cache of metrics records (see models.get_cached_records)
+    if app.config.get('METRICS_SHARED_CACHE'):
+        app.row_cache = SharedRowCache(app.config['METRICS_SHARED_CACHE'],
+                                       app.config['METRICS_SHARED_CACHE_SLOTS'],
+                                       app.config['METRICS_SHARED_CACHE_SLOT_SIZE'])
+    elif app.config.get('METRICS_ROW_CACHE_SIZE'):
+        app.row_cache = RowCache(app.config['METRICS_ROW_CACHE_SIZE'])
+    # Snapshot of the metrics table (see snapshot.py)
+    if app.config.get('METRICS_SNAPSHOT'):
+        app.snapshot = SnapshotStore(app.config['METRICS_SNAPSHOT'])
+    # Index of bibcodes (see models.get_identifiers)
+    if app.config.get('METRICS_BIBCODE_INDEX'):
+        app.bibcode_index = BibcodeIndex(
+            app.config.get('METRICS_BIBCODE_INDEX_FILE') or None,
+            app.config.get('METRICS_BIBCODE_INDEX_REFRESH', 60),
+            app.config.get('METRICS_BIBCODE_INDEX_RELOAD', 3600))
+    # Cache of metrics results (see metrics.get_cached_metrics)
+    if app.config.get('METRICS_RESULT_CACHE_SIZE'):
+        app.result_cache = ResultCache(app.config['METRICS_RESULT_CACHE_SIZE'],
+                                       app.config.get('METRICS_RESULT_CACHE_TTL', 0),
+                                       app.config.get('METRICS_RESULT_CACHE_STALE', False))
+
     return app
 
 if __name__ == "__main__":
@@ -0,0 +1,439 @@
+'''
+Caches of metrics records
+
+Records are stored by id (and can be found by bibcode) together with their
+modtime, so that cached copies can be checked against the database in bulk.
+RowCache keeps the records in the memory of one process, SharedRowCache in
+memory shared by all worker processes on a host. ResultCache holds complete
+(encoded) metrics results.
+'''
+from builtins import object
+from builtins import range
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import marshal
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+
+def estimate_size(value):
+    """
+    Approximate the number of bytes used by a record value (the citation
+    lists and Tori data make up most of it)
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v)
+                    for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(v) for v in value)
+    return size
+
+
+class RowCache(object):
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # id -> record (dictionary with at least 'id', 'bibcode' and
+        # 'modtime'), least recently used first
+        self.records = OrderedDict()
+        self.bibcodes = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, key, values, columns):
+        """
+        Return the cached records for the ids (key='id') or bibcodes
+        (key='bibcode') in values that have all the requested columns
+        """
+        found = []
+        with self.lock:
+            for value in values:
+                if key == 'bibcode':
+                    value = self.bibcodes.get(value)
+                record = self.records.pop(value, None)
+                if record is None:
+                    continue
+                self.records[value] = record
+                if all(c in record for c in columns):
+                    found.append(record)
+            self.hits += len(found)
+            self.misses += len(values) - len(found)
+        return found
+
+    def put(self, record):
+        """
+        Store a record retrieved from the database. Columns of a cached
+        copy with the same modtime are kept, so that records accumulate the
+        columns of different requests.
+        """
+        with self.lock:
+            cached = self._remove(record['id'])
+            if cached is not None and cached['modtime'] == record['modtime']:
+                cached.update(record)
+                record = cached
+            record['_size'] = estimate_size(record)
+            self.records[record['id']] = record
+            self.bibcodes[record['bibcode']] = record['id']
+            self.size += record['_size']
+            while self.size > self.max_bytes and self.records:
+                self._remove(next(iter(self.records)))
+        return record
+
+    def discard(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+            self.bibcodes.clear()
+            self.size = 0
+
+    def _remove(self, id):
+        record = self.records.pop(id, None)
+        if record is not None:
+            self.size -= record['_size']
+            if self.bibcodes.get(record['bibcode']) == id:
+                del self.bibcodes[record['bibcode']]
+        return record
+
+
+class SharedRowCache(object):
+
+    """
+    Cache of metrics records shared by all worker processes on a host
+
+    The records are stored in a memory mapped file (preferably on a tmpfs,
+    like /dev/shm) that is divided in fixed-size slots; a record is stored
+    in the slot given by its id, and replaces the record that was there
+    before. A record that does not fit in one slot continues in the slots
+    after it (up to a quarter of all slots), which are marked with the
+    negated id of the record plus one. Records are encoded with marshal,
+    so the encoded records are shared, but every reader copies a record out
+    of the mapping and decodes it in its own memory. Records are read
+    without any locking: every slot starts with a sequence number that is
+    odd while the slot is being written, so that readers can detect (and
+    ignore) a record that changed while it was read. There is only one
+    writer at a time, which is enforced with a lock on the file.
+    """
+
+    magic = b'MTRC'
+    version = 2
+    file_header = struct.Struct('<4sIII')
+    slot_header = struct.Struct('<IIq')
+    index_entry = struct.Struct('<q')
+
+    def __init__(self, path, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_span = max(1, slots // 4)
+        self.index_offset = self.file_header.size
+        self.slots_offset = self.index_offset + slots * self.index_entry.size
+        size = self.slots_offset + slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = threading.Lock()
+        with self.write_lock():
+            header = os.read(self.fd, self.file_header.size)
+            if header != self.file_header.pack(self.magic, self.version,
+                                               slots, slot_size):
+                # New file, or one with a different layout: start afresh
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, self.file_header.pack(
+                    self.magic, self.version, slots, slot_size))
+        self.map = mmap.mmap(self.fd, size)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        # The records that start in their slot and can be read completely
+        ids = [self.slot_header.unpack_from(self.map, self.slot_offset(n))[2]
+               for n in range(self.slots)]
+        return sum(1 for n, id in enumerate(ids) if id >= 0 and
+                   id % self.slots == n and self.read(id) is not None)
+
+    @contextmanager
+    def write_lock(self):
+        # flock only excludes other processes, so threads within this
+        # process are serialized with a regular lock
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def slot_offset(self, n):
+        return self.slots_offset + n * self.slot_size
+
+    def index_offset_for(self, bibcode):
+        n = (zlib.crc32(bibcode.encode('utf-8')) & 0xffffffff) % self.slots
+        return self.index_offset + n * self.index_entry.size
+
+    def span(self, length):
+        # The number of slots taken by a record of length bytes
+        payload = self.slot_size - self.slot_header.size
+        return max(1, -(-length // payload))
+
+    def read(self, id):
+        offsets = [self.slot_offset((id + n) % self.slots)
+                   for n in range(self.max_span)]
+        for attempt in range(3):
+            seq, length, slot_id = self.slot_header.unpack_from(
+                self.map, offsets[0])
+            if seq % 2:
+                continue
+            if slot_id != id or not length or \
+               self.span(length) > self.max_span:
+                return None
+            seqs = [seq]
+            parts = []
+            for n, offset in enumerate(offsets[:self.span(length)]):
+                if n:
+                    seq, size, slot_id = self.slot_header.unpack_from(
+                        self.map, offset)
+                    seqs.append(seq)
+                    if seq % 2:
+                        break
+                    if slot_id != -(id + 1):
+                        # The rest of the record has been overwritten
+                        return None
+                else:
+                    size = min(length, self.slot_size - self.slot_header.size)
+                start = offset + self.slot_header.size
+                parts.append(self.map[start:start + size])
+            if len(parts) < len(seqs) or \
+               [self.slot_header.unpack_from(self.map, offset)[0] for offset
+                in offsets[:len(seqs)]] != seqs:
+                continue
+            data = b''.join(parts)
+            if len(data) != length:
+                return None
+            try:
+                return decode_record(data)
+            except (ValueError, EOFError, TypeError):
+                return None
+        return None
+
+    def lookup(self, key, values, columns):
+        found = []
+        for value in values:
+            if key == 'bibcode':
+                id = self.index_entry.unpack_from(
+                    self.map, self.index_offset_for(value))[0] - 1
+                record = self.read(id) if id >= 0 else None
+                if record is not None and record['bibcode'] != value:
+                    record = None
+            else:
+                record = self.read(value)
+            if record is not None and all(c in record for c in columns):
+                found.append(record)
+        self.hits += len(found)
+        self.misses += len(values) - len(found)
+        return found
+
+    def put(self, record):
+        with self.write_lock():
+            cached = self.read(record['id'])
+            if cached is not None and cached['modtime'] == record['modtime']:
+                cached.update(record)
+                if self.write(cached):
+                    return cached
+            self.write(record)
+        return record
+
+    def write(self, record):
+        # Only to be called with the write lock held
+        try:
+            data = encode_record(record)
+        except ValueError:
+            return False
+        span = self.span(len(data))
+        if span > self.max_span:
+            return False
+        id = record['id']
+        payload = self.slot_size - self.slot_header.size
+        offsets = [self.slot_offset((id + n) % self.slots) for n in range(span)]
+        seqs = [self.slot_header.unpack_from(self.map, offset)[0]
+                for offset in offsets]
+        # The first slot has the length of the record, the others the length
+        # of their part
+        parts = [data[n * payload:(n + 1) * payload] for n in range(span)]
+        ids = [id] + [-(id + 1)] * (span - 1)
+        lengths = [len(data)] + [len(part) for part in parts[1:]]
+        for offset, seq, slot_id in zip(offsets, seqs, ids):
+            self.slot_header.pack_into(self.map, offset, next_seq(seq, 1), 0,
+                                       slot_id)
+        for offset, part in zip(offsets, parts):
+            start = offset + self.slot_header.size
+            self.map[start:start + len(part)] = part
+        for offset, seq, length, slot_id in zip(offsets, seqs, lengths, ids):
+            self.slot_header.pack_into(self.map, offset, next_seq(seq, 2),
+                                       length, slot_id)
+        self.index_entry.pack_into(self.map,
+                                   self.index_offset_for(record['bibcode']),
+                                   record['id'] + 1)
+        return True
+
+    def discard(self, id):
+        with self.write_lock():
+            offset = self.slot_offset(id % self.slots)
+            seq, length, slot_id = self.slot_header.unpack_from(self.map, offset)
+            if slot_id == id:
+                self.slot_header.pack_into(self.map, offset, next_seq(seq, 2), 0, 0)
+
+    def clear(self):
+        with self.write_lock():
+            for n in range(self.slots):
+                offset = self.slot_offset(n)
+                seq = self.slot_header.unpack_from(self.map, offset)[0]
+                self.slot_header.pack_into(self.map, offset, next_seq(seq, 2), 0, 0)
+
+
+def next_seq(seq, n):
+    return (seq + n) & 0xffffffff
+
+
+def encode_record(record):
+    # marshal does not support datetimes, so modtime is stored as a tuple
+    record = dict(record)
+    record.pop('_size', None)
+    modtime = record.get('modtime')
+    if isinstance(modtime, datetime):
+        record['modtime'] = modtime.timetuple()[:6] + (modtime.microsecond,)
+    return marshal.dumps(record, 2)
+
+
+def decode_record(data):
+    record = marshal.loads(data)
+    if isinstance(record.get('modtime'), tuple):
+        record['modtime'] = datetime(*record['modtime'])
+    return record
+
+
+class ResultCache(object):
+
+    """
+    Cache of encoded metrics results
+
+    Within ttl seconds after it was computed (or last checked), a result is
+    served as is. After that, the validator of the result (computed from the
+    records it is based on) is checked: if it changed, the result is
+    computed again or, with stale=True, the old result is served while a
+    new one is computed in the background. A validator of None means that
+    the result cannot be checked: it is computed every time and not cached.
+    Only one thread computes the result for a given key at a time; the
+    others wait for it and use its result. The least recently used results
+    are evicted when the total size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes, ttl, stale=False):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale = stale
+        self.size = 0
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = [threading.Lock() for n in range(64)]
+        self.refreshing = set()
+
+    def __len__(self):
+        return len(self.results)
+
+    def key_lock(self, key):
+        return self.key_locks[zlib.crc32(key.encode('utf-8')) % len(self.key_locks)]
+
+    def get(self, key, validate, compute):
+        """
+        Return the result for key. validate() returns the current validator
+        for the result, compute() returns the result and whether it may be
+        cached.
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            if time.time() - entry['checked'] < self.ttl:
+                return entry['data']
+            validator = validate()
+            if validator == entry['validator']:
+                entry['checked'] = time.time()
+                return entry['data']
+            if self.stale:
+                self.refresh(key, validator, compute)
+                return entry['data']
+        else:
+            validator = validate()
+        with self.key_lock(key):
+            # The result may have been computed while we were waiting
+            entry = self.lookup(key)
+            if entry is not None and entry['validator'] == validator:
+                return entry['data']
+            return self.update(key, validator, compute)
+
+    def update(self, key, validator, compute):
+        data, cacheable = compute()
+        if cacheable and validator is not None:
+            self.put(key, data, validator)
+        else:
+            self.discard(key)
+        return data
+
+    def refresh(self, key, validator, compute):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                with self.key_lock(key):
+                    self.update(key, validator, compute)
+            except Exception:
+                self.discard(key)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.results.pop(key, None)
+            if entry is not None:
+                self.results[key] = entry
+        return entry
+
+    def put(self, key, data, validator):
+        with self.lock:
+            self._remove(key)
+            if len(data) > self.max_bytes:
+                return
+            self.results[key] = {'data': data, 'validator': validator,
+                                 'checked': time.time()}
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.results)))
+
+    def discard(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.results.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry['data'])
@@ -0,0 +1,59 @@
+'''
+Integer codec for bibcodes
+
+The bibcode_dictionary table maps every citing bibcode to an int64
+identifier, and the metrics table has the citations as arrays of these
+identifiers next to the arrays of bibcodes. The publication year of a
+bibcode is kept in the bits above YEAR_SHIFT of its identifier, so that the
+citation years follow from the identifiers without decoding them. Bibcodes
+only need to be decoded when they end up in the results (like the
+self-citations).
+'''
+from builtins import object
+import numpy as np
+from .models import get_bibcode_ids
+from .models import get_dictionary_bibcodes
+
+YEAR_SHIFT = 40
+
+
+def as_ids(ids):
+    return np.asarray(ids if ids is not None else [], dtype=np.int64)
+
+
+def bibcode_years(ids):
+    # The publication years of the bibcodes with these identifiers
+    return np.right_shift(as_ids(ids), YEAR_SHIFT)
+
+
+class BibcodeCodec(object):
+
+    """
+    Encodes and decodes bibcodes with the bibcode dictionary. The
+    identifiers of the bibcodes given to the constructor are retrieved in
+    one go; identifiers of other bibcodes are looked up when decoded.
+    Bibcodes that are not in the dictionary (because nothing cites them)
+    have no identifier.
+    """
+
+    def __init__(self, bibcodes):
+        self.ids = {}
+        self.bibcodes = {}
+        self.add(get_bibcode_ids(list(set(bibcodes))))
+
+    def add(self, rows):
+        for row in rows:
+            self.ids[row.bibcode] = row.id
+            self.bibcodes[row.id] = row.bibcode
+
+    def encode(self, bibcodes):
+        # Sorted array of the (unique) identifiers of the bibcodes
+        return np.unique(as_ids([self.ids[b] for b in bibcodes
+                                 if b in self.ids]))
+
+    def decode(self, ids):
+        ids = [int(i) for i in ids]
+        missing = [i for i in ids if i not in self.bibcodes]
+        if missing:
+            self.add(get_dictionary_bibcodes(missing))
+        return [self.bibcodes[i] for i in ids if i in self.bibcodes]
@@ -0,0 +1,196 @@
+'''
+In-process index of bibcodes
+
+Maps bibcodes to their id and refereed status, so that the records of a
+request can be identified without a database query. The bibcodes are kept
+as a sorted array of fixed-width bytes (searched with binary search), next
+to arrays of the ids and refereed flags. The index is brought up to date
+with the records modified since the latest modtime it has seen (every
+refresh seconds), and it is loaded completely again every reload seconds,
+or as soon as the number of records no longer matches the metrics table
+(which drops deleted records). The index is loaded and updated in a
+background thread, which replaces the arrays once the new ones are built;
+until the index has been loaded, the bibcodes are looked up in the
+database. With a path, the index is saved to that file whenever it
+changes, and new workers start from the saved index.
+'''
+from builtins import object
+from datetime import datetime
+from flask import current_app
+import os
+import threading
+import time
+import numpy as np
+from .models import stream_identifier_data
+from .models import get_modified_identifiers
+from .models import count_identifiers
+from .snapshot import find
+
+
+class BibcodeIndex(object):
+
+    def __init__(self, path=None, refresh=60, reload=3600):
+        self.path = path
+        self.refresh = refresh
+        self.reload = reload
+        self.lock = threading.Lock()
+        # (bibcodes, ids, refereed)
+        self.data = None
+        self.modtime = None
+        self.loaded = 0
+        self.checked = 0
+        # The thread that is updating the index (if any)
+        self.thread = None
+        if path and os.path.exists(path):
+            try:
+                self.read(path)
+            except Exception:
+                self.data = None
+
+    def __len__(self):
+        return len(self.data[0]) if self.data is not None else 0
+
+    def lookup(self, bibcodes):
+        """
+        The (bibcode, id, refereed) tuples of the bibcodes that are in the
+        index (in the same form as models.get_identifiers), or None when the
+        index has not been loaded yet
+        """
+        self.update()
+        if self.data is None:
+            return None
+        bibs, ids, refereed = self.data
+        width = bibs.dtype.itemsize
+        keys = [b.encode('utf-8') for b in set(bibcodes)]
+        keys = np.array([k for k in keys if len(k) <= width],
+                        dtype=bibs.dtype)
+        positions = np.sort(find(keys, bibs)[0])
+        return list(zip([b.decode('utf-8') for b in bibs[positions].tolist()],
+                        ids[positions].tolist(),
+                        refereed[positions].tolist()))
+
+    def update(self):
+        """
+        Start bringing the index up to date in a background thread, if it
+        is due and no other thread is doing so. The current arrays are
+        served until the thread replaces them.
+        """
+        if time.time() - self.checked < self.refresh:
+            return
+        with self.lock:
+            if self.thread is not None or \
+               time.time() - self.checked < self.refresh:
+                return
+            self.checked = time.time()
+            app = current_app._get_current_object()
+
+            def run():
+                try:
+                    with app.app_context():
+                        self.run_update()
+                except Exception as err:
+                    app.logger.error('Unable to update the bibcode index: %s'
+                                     % err)
+                finally:
+                    with self.lock:
+                        self.thread = None
+
+            self.thread = threading.Thread(target=run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run_update(self):
+        if self.data is None or time.time() - self.loaded >= self.reload:
+            self.load()
+            changed = True
+        else:
+            changed = self.load_changes()
+        if changed and self.path:
+            self.write(self.path)
+
+    def load(self):
+        bibcodes = []
+        ids = []
+        refereed = []
+        modtime = None
+        loaded = time.time()
+        for batch in stream_identifier_data():
+            for r in batch:
+                bibcodes.append(r.bibcode.encode('utf-8'))
+                ids.append(r.id)
+                refereed.append(bool(r.refereed))
+                if r.modtime is not None and (modtime is None or
+                                              r.modtime > modtime):
+                    modtime = r.modtime
+        self.build(bibcodes, ids, refereed)
+        self.modtime = modtime
+        self.loaded = loaded
+
+    def load_changes(self):
+        """
+        Apply the records modified since the latest modtime seen, and load
+        the index again if the number of records then differs from the
+        metrics table: deleted records (and records without a modtime) are
+        not found among the modified records. Returns whether the index
+        changed.
+        """
+        # Records modified at the latest modtime seen are retrieved again,
+        # because others may have been committed with the same modtime
+        rows = get_modified_identifiers(self.modtime or datetime(1, 1, 1))
+        changed = self.apply_changes(rows)
+        if len(self) != count_identifiers():
+            self.load()
+            return True
+        return changed
+
+    def apply_changes(self, rows):
+        bibs, ids, refereed = self.data
+        keys = np.array([r.bibcode.encode('utf-8') for r in rows], dtype=bytes)
+        if len(keys) and keys.dtype.itemsize <= bibs.dtype.itemsize:
+            positions, found = find(keys.astype(bibs.dtype), bibs)
+            if found.all() and \
+               ids[positions].tolist() == [r.id for r in rows] and \
+               refereed[positions].tolist() == [bool(r.refereed) for r in rows]:
+                return False
+        elif not len(keys):
+            return False
+        # The records that changed replace their previous entries
+        keep = ~np.isin(ids, np.array([r.id for r in rows], dtype=np.int64))
+        self.build(
+            np.concatenate([bibs[keep], keys]),
+            np.concatenate([ids[keep], np.array(
+                [r.id for r in rows], dtype=np.int64)]),
+            np.concatenate([refereed[keep], np.array(
+                [bool(r.refereed) for r in rows], dtype=bool)]))
+        # The index may not have seen any modtime yet
+        modtimes = [m for m in [self.modtime] + [r.modtime for r in rows]
+                    if m is not None]
+        self.modtime = max(modtimes) if modtimes else None
+        return True
+
+    def build(self, bibcodes, ids, refereed):
+        bibcodes = np.array(bibcodes, dtype=bytes)
+        order = np.argsort(bibcodes, kind='mergesort')
+        self.data = (bibcodes[order],
+                     np.asarray(ids, dtype=np.int64)[order],
+                     np.asarray(refereed, dtype=bool)[order])
+
+    def read(self, path):
+        with np.load(path) as saved:
+            self.data = (saved['bibcodes'], saved['ids'], saved['refereed'])
+            modtime = str(saved['modtime'])
+            self.modtime = datetime.strptime(modtime, '%Y-%m-%dT%H:%M:%S.%f') \
+                if modtime else None
+            self.loaded = float(saved['loaded'])
+
+    def write(self, path):
+        # Written to a temporary file first, so that workers never read a
+        # partially written index
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        bibcodes, ids, refereed = self.data
+        modtime = self.modtime.strftime('%Y-%m-%dT%H:%M:%S.%f') \
+            if self.modtime else ''
+        with open(tmp, 'wb') as f:
+            np.savez(f, bibcodes=bibcodes, ids=ids, refereed=refereed,
+                     modtime=np.array(modtime), loaded=np.array(self.loaded))
+        os.rename(tmp, path)
@@ -15,10 +15,12 @@ import urllib.request, urllib.parse, urllib.error
 import itertools
 #import simplejson as json
 import json
+import hashlib
 import numpy as np
 import cytoolz as cy
 from math import sqrt
 from collections import defaultdict
+from collections import namedtuple
 from operator import itemgetter
 from datetime import date, datetime
 from .models import get_identifiers
@@ -30,6 +32,16 @@ from .models import get_usage_data
 from .models import get_indicator_data
 from .models import get_tori_data
 from .models import get_citations_single
+from .models import get_citation_records
+from .models import get_metrics_data
+from .models import get_modtime_summary
+from .models import get_summary_data
+from .models import chunks
+from .models import get_snapshot
+from .models import request_session
+from .codec import BibcodeCodec
+from .codec import as_ids
+from .codec import bibcode_years
 
 # Helper methods
 class MyEncoder(json.JSONEncoder):
@@ -43,14 +55,6 @@ class MyEncoder(json.JSONEncoder):
         else:
             return super(MyEncoder, self).default(obj)
 
-def chunks(l, n):
-    """
-    Yield successive n-sized chunks from l.
-    """
-    for i in range(0, len(l), n):
-        yield l[i:i + n]
-
-
 def get_norm_histo(l):
     d = defaultdict(list)
     for tag, num in l:
@@ -64,10 +68,114 @@ def merge_dictionaries(x, y):
     z.update(y)
     return z
 
+# Columns of the metrics table always needed to identify, order and filter
+# records, and the (potentially wide) columns retrieved only when the
+# requested metrics need them
+base_columns = ['bibcode', 'refereed', 'author_num', 'citation_num']
+data_columns = ['refereed_citation_num', 'reads', 'downloads', 'citations',
+                'refereed_citations', 'rn_citation_data', 'citation_years_start',
+                'refereed_citation_years', 'nonrefereed_citation_years',
+                'citation_ids', 'refereed_citation_ids', 'tori_ids',
+                'tori_pubyears', 'tori_cityears', 'tori_weights']
+citation_years_columns = ['citation_years_start', 'refereed_citation_years',
+                          'nonrefereed_citation_years']
+citation_ids_columns = ['citation_ids', 'refereed_citation_ids']
+tori_columns = ['tori_ids', 'tori_pubyears', 'tori_cityears', 'tori_weights']
+
+
+def get_columns(metrics_types, histograms=None, tori=True,
+                citation_years=False, citation_ids=False, tori_arrays=False):
+    """
+    Determine the minimal set of columns needed for the requested metrics
+    types, histograms and Tori. With citation_years, the citation histograms
+    and time series use the citation counts per year. With citation_ids,
+    the citations are retrieved as bibcode identifiers. With tori_arrays,
+    the Tori uses the arrays derived from rn_citation_data.
+    """
+    histograms = histograms or []
+    timeseries = 'timeseries' in metrics_types or \
+        'time series' in metrics_types
+    citations = 'citation_ids' if citation_ids else 'citations'
+    needed = set()
+    if 'basic' in metrics_types:
+        needed.update(['reads', 'downloads'])
+    if 'citations' in metrics_types:
+        # The citations are needed for the self-citations and the number
+        # of citing papers
+        needed.update(['refereed_citation_num', citations])
+    if 'histograms' in metrics_types:
+        # The records with reads are the usage data for the downloads as
+        # well
+        if 'reads' in histograms:
+            needed.add('reads')
+        if 'downloads' in histograms:
+            needed.update(['reads', 'downloads'])
+        if 'citations' in histograms and citation_years:
+            needed.update(citation_years_columns)
+        elif 'citations' in histograms and citation_ids:
+            needed.update(citation_ids_columns)
+        elif 'citations' in histograms:
+            needed.update(['citations', 'refereed_citations'])
+    if 'indicators' in metrics_types:
+        # Only citation counts are needed, apart from the reads for read10
+        needed.add('reads')
+    if timeseries and citation_years:
+        needed.update(['reads'] + citation_years_columns)
+    elif timeseries:
+        needed.update(['reads', citations])
+    if tori and ('indicators' in metrics_types or timeseries):
+        # The Tori needs the self-citations to be excluded
+        needed.add(citations)
+        if tori_arrays:
+            needed.update(tori_columns)
+        else:
+            needed.add('rn_citation_data')
+    return base_columns + [c for c in data_columns if c in needed]
+
 # Main engine: retrieves the desired statistics
 
 
 def generate_metrics(**args):
+    # The next line takes care of mapping numpy float64 and int64 values to regular floats and integers
+    # (JSON serialization fails for numpy float64 and int64 classes)
+    result = compute_metrics(**args)
+    return json.loads(encode_metrics(result))
+
+
+def encode_metrics(result):
+    return json.dumps(result, cls=MyEncoder)
+
+
+def get_cached_metrics(cache, **args):
+    """
+    Get the metrics (as JSON) through the result cache. Results are cached
+    under a hash of the sorted bibcodes and the metrics options, and they
+    are checked against the ids and modtimes of the records. Only
+    results without skipped bibcodes are stored, because the skipped
+    bibcodes are reported in the order of the request.
+    Returns None when there is no data to generate metrics.
+    """
+    app = current_app._get_current_object()
+    key = json.dumps([sorted(set(args['bibcodes'])), sorted(args['types']),
+                      sorted(args['histograms']), bool(args['tori'])])
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def validate():
+        return get_modtime_summary(args['bibcodes'])
+
+    def compute():
+        # This may run in a background thread (when a stale result is
+        # refreshed)
+        with app.app_context():
+            result = compute_metrics(**args)
+        if not result:
+            return None, False
+        return encode_metrics(result), not result['skipped bibcodes']
+
+    return cache.get(key, validate, compute)
+
+
+def compute_metrics(**args):
     result = {}
     usage_data = None
     citdata = None
@@ -79,44 +187,116 @@ def generate_metrics(**args):
     if len(metrics_types) == 0:
         return result
     tori = args.get('tori', True)
-    # First retrieve the data we need for our calculations
-    bibcodes, bibcodes_ref, identifiers, skipped = get_record_info(
-        bibcodes=args.get('bibcodes', []), query=args.get('query', None))
-#    if len(bibcodes) == 1 and len(metrics_types) == 0:
-#        metrics_types = ['basic', 'citations', 'histograms']
-    # If no identifiers were returned, return empty results
-    if len(identifiers) == 0:
-        return result
-    # Record the bibcodes that fell off the wagon
-    result['skipped bibcodes'] = skipped
-    # If there are skipped records, create a log message
-    if len(skipped) > 0:
-        current_app.logger.warning('Found %s skipped bibcodes in metrics request: %s'%(len(skipped),",".join(skipped)))
+    # First retrieve the data we need for our calculations, in one
+    # transaction (see models.request_session) that ends, and releases its
+    # connection, before the statistics are computed
+    with request_session():
+        bibcodes, bibcodes_ref, identifiers, skipped = get_record_info(
+            bibcodes=args.get('bibcodes', []), query=args.get('query', None))
+    #    if len(bibcodes) == 1 and len(metrics_types) == 0:
+    #        metrics_types = ['basic', 'citations', 'histograms']
+        # If no identifiers were returned, return empty results
+        if len(identifiers) == 0:
+            return result
+        # Record the bibcodes that fell off the wagon
+        result['skipped bibcodes'] = skipped
+        # If there are skipped records, create a log message
+        if len(skipped) > 0:
+            current_app.logger.warning('Found %s skipped bibcodes in metrics request: %s'%(len(skipped),",".join(skipped)))
+        # A snapshot of the metrics table has the citations as bibcode
+        # identifiers and the Tori arrays (and nothing else is needed)
+        snapshot = get_snapshot() is not None
+        # The basic stats can be computed from the metrics_summary table, as
+        # long as it has all records (it may lag behind the metrics table)
+        summary = None
+        if 'basic' in metrics_types and not snapshot and \
+           current_app.config.get('METRICS_SUMMARY_TABLE', False):
+            summary = get_summary_data(identifiers)
+            if len(summary) != len(identifiers):
+                summary = None
+        data_types = metrics_types
+        if summary is not None:
+            data_types = [t for t in metrics_types if t != 'basic']
+        # The citation histograms and time series can use the precomputed
+        # citation counts per year instead of the citations, and the citations
+        # can be retrieved as bibcode identifiers
+        citation_years = current_app.config.get('METRICS_CITATION_YEARS', False) \
+            and not snapshot
+        citation_ids = current_app.config.get('METRICS_CITATION_IDS', False) \
+            or snapshot
+        tori_arrays = current_app.config.get('METRICS_TORI_ARRAYS', False) \
+            or snapshot
+        columns = get_columns(data_types, histograms=args.get('histograms'),
+                              tori=tori, citation_years=citation_years,
+                              citation_ids=citation_ids, tori_arrays=tori_arrays)
+        # Retrieve all data needed for the requested metrics in one go. The
+        # records come back ordered by citation_num (most cited first), so the
+        # subsets derived from it keep that ordering
+        if data_types:
+            data = get_metrics_data(identifiers, columns)
+        else:
+            data = []
+        # Records for which the counts or identifiers have not been computed
+        # (yet) need the citations after all
+        derived = [c for c in ('refereed_citation_years', 'citation_ids',
+                               'tori_weights') if c in columns]
+        if any(getattr(p, c) is None for p in data for c in derived):
+            columns = get_columns(data_types, histograms=args.get('histograms'),
+                                  tori=tori)
+            data = get_metrics_data(identifiers, columns)
+    # The subset of records with citations
+    citdata = [p for p in data if p.citation_num != 0]
+    # The basic stats use all records as usage data, otherwise only records
+    # with reads are considered
+    if 'basic' in metrics_types:
+        usage_data = data
+    elif 'reads' in columns:
+        usage_data = [p for p in data if p.reads]
+    citlists = citdata
+    selfcits = None
+    # The usage matrices are shared by the basic stats, the usage
+    # histograms and the read10 time series (and have the records of the
+    # usage data)
+    timeseries = 'timeseries' in metrics_types or \
+        'time series' in metrics_types
+    usage = {}
+    if 'basic' in data_types or 'histograms' in metrics_types or timeseries:
+        usage = dict((t, get_usage_matrix(usage_data, t))
+                     for t in ('reads', 'downloads') if t in columns)
     # Start calculating the required statistics and indicators
-    citdata = usage_data = citlists = selfcits = None
     if 'basic' in metrics_types:
-        basic_stats, basic_stats_refereed, usage_data = \
-            get_basic_stats(identifiers)
+        if summary is not None:
+            basic_stats, basic_stats_refereed = \
+                get_summary_stats(identifiers, summary)
+        else:
+            basic_stats, basic_stats_refereed, usage_data = \
+                get_basic_stats(identifiers, data=data, usage=usage)
         result['basic stats'] = basic_stats
         result['basic stats refereed'] = basic_stats_refereed
     if 'citations' in metrics_types:
         cite_stats, cite_stats_refereed, citdata, selfcits, citlists = \
-            get_citation_stats(identifiers, bibcodes, bibcodes_ref)
+            get_citation_stats(identifiers, bibcodes, bibcodes_ref,
+                               data=citdata)
         result['citation stats'] = cite_stats
         result['citation stats refereed'] = cite_stats_refereed
     if 'histograms' in metrics_types:
         hists = {}
         hist_types = args.get('histograms')
         if 'publications' in hist_types and len(identifiers) > 1:
-            hists['publications'] = get_publication_histograms(identifiers)
+            hists['publications'] = get_publication_histograms(
+                identifiers, data=data)
         if 'reads' in hist_types:
-            hists['reads'] = get_usage_histograms(identifiers, data=usage_data)
+            hists['reads'] = get_usage_histograms(
+                identifiers, data=usage_data, usage=usage.get('reads'))
         if 'downloads' in hist_types and len(identifiers) > 1:
             hists['downloads'] = get_usage_histograms(
-                identifiers, usage_type='downloads', data=usage_data)
+                identifiers, usage_type='downloads', data=usage_data,
+                usage=usage.get('downloads'))
         if 'citations' in hist_types:
+            # Without any cited records, the histograms are based on all
+            # records
             hists['citations'] = get_citation_histograms(
-                identifiers, data=citlists)
+                identifiers, data=citlists or data)
         result['histograms'] = hists
     if 'indicators' in metrics_types:
         indicators = {}
@@ -124,7 +304,7 @@ def generate_metrics(**args):
             identifiers, data=citdata, usagedata=usage_data)
         if tori:
             tori, tori_ref, riq, riq_ref, tdata = get_tori(
-                identifiers, bibcodes, self_cits=selfcits)
+                identifiers, bibcodes, self_cits=selfcits, data=citlists)
             indic['tori'] = tori
             indic['riq'] = riq
             indic_ref['tori'] = tori_ref
@@ -136,7 +316,10 @@ def generate_metrics(**args):
             indic_ref['riq'] = 'NA'
         result['indicators'] = indic
         result['indicators refereed'] = indic_ref
-    if 'timeseries' in metrics_types or 'time series' in metrics_types:
+    if timeseries:
+        if tori and tdata is None:
+            tdata = get_tori(identifiers, bibcodes, self_cits=selfcits,
+                             data=citlists)[4]
         result['time series'] = get_time_series(
             identifiers,
             bibcodes,
@@ -144,11 +327,9 @@ def generate_metrics(**args):
             usagedata=usage_data,
             tori_data=tdata,
             include_tori=tori,
-            self_cits=selfcits)
-    # The next line takes care of mapping numpy float64 and int64 values to regular floats and integers
-    # (JSON serialization fails for numpy float64 and int64 classes)
-    res = json.loads(json.dumps(result, cls=MyEncoder))
-    return res
+            self_cits=selfcits,
+            usage=usage.get('reads'))
+    return result
 
 # Data retrieval methods
 # A. Data before we any sort of computation
@@ -174,35 +355,124 @@ def get_record_info(**args):
 # Get citations, self-citations
 
 
-def get_selfcitations(identifiers, bibcodes):
-    data = get_citations(identifiers)
+def get_selfcitations(identifiers, bibcodes, data=None):
+    if data is None:
+        data = get_citations(identifiers)
     # record the actual self-citations so that we can use that
     # information later on in the calculation of the Tori
     try:
-        selfcits = [
-            (set(p.citations).intersection(set(bibcodes)), p.refereed)
-            for p in data]
-    except:
-        selfcits = [([], False)]
+        selfcits = get_citation_lists(bibcodes, data)
+    except (AttributeError, TypeError):
+        selfcits = get_citation_lists(bibcodes, [])
         return data, selfcits, 0, 0, 0, 0
-    Nself = sum([len(c[0]) for c in selfcits])
-    Nself_refereed = sum([len(c[0]) * c[1] for c in selfcits])
-    Nciting = len(set(itertools.chain(*[p.citations for p in data])))
-    Nciting_ref = len(
-    set(itertools.chain(*[p.citations for p in data if p.refereed])))
+    rows = get_selfcitation_pairs(selfcits)[0]
+    Nself = len(rows)
+    Nself_refereed = int(np.count_nonzero(selfcits.refereed[rows]))
+    Nciting = len(selfcits.papers)
+    citing_rows = np.repeat(np.arange(len(selfcits.refereed)),
+                            np.diff(selfcits.offsets))
+    Nciting_ref = len(np.unique(
+        selfcits.citing[selfcits.refereed[citing_rows]]))
     return data, selfcits, Nself, Nself_refereed, Nciting, Nciting_ref
 
+
+# The citations of the records in compressed sparse row form: the citing
+# papers of record n are the integer codes citing[offsets[n]:offsets[n + 1]],
+# which number the citing papers (bibcodes or bibcode identifiers) in
+# papers. The citing papers that are among the bibcodes themselves have the
+# lowest codes, and self_citations has their bibcodes.
+CitationLists = namedtuple(
+    'CitationLists',
+    ['offsets', 'citing', 'refereed', 'papers', 'self_citations'])
+
+
+def get_citation_lists(bibcodes, data):
+    """
+    The citations of the records as CitationLists, from the citations as
+    bibcodes or as bibcode identifiers (of which only the self-citations
+    are decoded)
+    """
+    if data and has_citation_ids(data):
+        codec = BibcodeCodec(bibcodes)
+        lists = [as_ids(p.citation_ids) for p in data]
+        papers, citing = np.unique(np.concatenate([as_ids([])] + lists),
+                                   return_inverse=True)
+        own = np.isin(papers, codec.encode(bibcodes))
+        self_citations = codec.decode(papers[own])
+    else:
+        lists = [p.citations for p in data]
+        citations = list(itertools.chain(*lists))
+        # The citing papers are numbered in order of appearance
+        index = dict.fromkeys(citations)
+        papers = list(index)
+        index.update(zip(papers, itertools.count()))
+        own = np.zeros(len(papers), dtype=bool)
+        own[[index[b] for b in set(bibcodes).intersection(index)]] = True
+        self_citations = [papers[n] for n in np.flatnonzero(own).tolist()]
+        # The codes of all citations are looked up in one go (itemgetter
+        # gives a single code for a single citation)
+        citing = np.array(itemgetter(*citations)(index)
+                          if citations else [], dtype=np.int64, ndmin=1)
+    # Renumber the citing papers with the self-citations first
+    order = np.argsort(~own, kind='stable')
+    codes = np.empty(len(order), dtype=np.int64)
+    codes[order] = np.arange(len(order))
+    if isinstance(papers, np.ndarray):
+        papers = papers[order]
+    else:
+        papers = np.array(papers, dtype=object)[order].tolist()
+    offsets = np.cumsum([0] + [len(c) for c in lists], dtype=np.int64)
+    refereed = np.array([bool(p.refereed) for p in data], dtype=bool)
+    return CitationLists(offsets, codes[citing.astype(np.int64)], refereed,
+                         papers, self_citations)
+
+
+def get_selfcitation_pairs(citation_lists):
+    """
+    The records and codes of the self-citations (every citing paper once
+    per record that it cites), in the order of the citations
+    """
+    Nself = len(citation_lists.self_citations)
+    rows = np.repeat(np.arange(len(citation_lists.refereed)),
+                     np.diff(citation_lists.offsets))
+    selfcited = citation_lists.citing < Nself
+    rows = rows[selfcited]
+    codes = citation_lists.citing[selfcited]
+    first = np.sort(np.unique(rows * Nself + codes, return_index=True)[1])
+    return rows[first], codes[first]
+
+
+def get_selfcitation_list(citation_lists):
+    # The self-citations of all records (as from get_selfcitation_pairs)
+    codes = get_selfcitation_pairs(citation_lists)[1]
+    return [citation_lists.self_citations[c] for c in codes.tolist()]
+
+
+def get_selfcitation_ids(citation_lists):
+    """
+    The bibcode identifiers of the self-citations: when the citations are
+    bibcodes, they are looked up in the bibcode dictionary
+    """
+    Nself = len(citation_lists.self_citations)
+    if isinstance(citation_lists.papers, np.ndarray):
+        return citation_lists.papers[:Nself]
+    if Nself == 0:
+        return as_ids([])
+    codec = BibcodeCodec(citation_lists.self_citations)
+    return codec.encode(citation_lists.self_citations)
+
 # B. Statistics functions
 # The basic stats function gets the publication and usage stats
 
 
-def get_basic_stats(identifiers):
+def get_basic_stats(identifiers, data=None, usage=None):
     # basic stats for all publications
     bs = {}
     # basic stats for refereed publications`
     bsr = {}
     # Get the data to calculate the basic stats
-    data = get_basic_stats_data(identifiers)
+    if data is None:
+        data = get_basic_stats_data(identifiers)
     # First get the number of (refereed) papers
     bs['number of papers'] = len(identifiers)
     bsr['number of papers'] = len([p for p in data if p.refereed])
@@ -212,14 +482,11 @@ def get_basic_stats(identifiers):
     bsr['normalized paper count'] = np.sum(
         np.array([1.0 / float(p.author_num) for p in data if p.refereed]), dtype=float)
     # Get the total number of reads
-    year = datetime.now().year
-    Nentries = year - 1996 + 1
-    reads = [p.reads for p in data if p.reads and len(p.reads) == Nentries]
-    reads_ref = [
-        p.reads for p in data if p.refereed and p.reads and
-        len(p.reads) == Nentries]
-    reads_totals = [sum(r) for r in reads]
-    reads_ref_totals = [sum(r) for r in reads_ref]
+    usage = usage or {}
+    reads = usage.get('reads') or get_usage_matrix(data, 'reads')
+    reads_totals = reads.usage.sum(axis=1)
+    reads_ref_totals = reads_totals[reads.refereed].tolist()
+    reads_totals = reads_totals.tolist()
     bs['total number of reads'] = np.sum(reads_totals or [0], dtype=int)
     bsr['total number of reads'] = np.sum(reads_ref_totals or [0], dtype=int)
     # Get the average number of reads
@@ -234,27 +501,14 @@ def get_basic_stats(identifiers):
     # Get the median number of reads
     bs['median number of reads'] = np.median(reads_totals or [0])
     bsr['median number of reads'] = np.median(reads_ref_totals or [0])
-    # Get the normalized number of reads
-    # bs['normalized number of reads'] = \
-    # np.sum([np.array(p.reads)/float(p.author_num)
-    # for p in data if p.reads and len(p.reads) == Nentries])
-    # bsr['normalized number of reads'] = \
-    # sum([p.reads[-1] for p in data if p.refereed and
-    # p.reads and len(p.reads) == Nentries])
     # and finally, get the recent reads
-    bs['recent number of reads'] = sum(
-        [p.reads[-1] for p in data if p.reads and len(p.reads) == Nentries])
-    bsr['recent number of reads'] = sum(
-        [p.reads[-1] for p in data if p.refereed and p.reads and
-         len(p.reads) == Nentries])
+    bs['recent number of reads'] = int(reads.usage[:, -1].sum())
+    bsr['recent number of reads'] = int(reads.usage[reads.refereed, -1].sum())
     # Do the same for the downloads
-    downloads = [
-        p.downloads for p in data if p.downloads and
-        len(p.downloads) == Nentries]
-    downloads_ref = [p.downloads for p in data if p.refereed and
-                     p.downloads and len(p.downloads) == Nentries]
-    downloads_totals = [sum(d) for d in downloads]
-    downloads_ref_totals = [sum(d) for d in downloads_ref]
+    downloads = usage.get('downloads') or get_usage_matrix(data, 'downloads')
+    downloads_totals = downloads.usage.sum(axis=1)
+    downloads_ref_totals = downloads_totals[downloads.refereed].tolist()
+    downloads_totals = downloads_totals.tolist()
     bs['total number of downloads'] = np.sum(downloads_totals or [0], dtype=int)
     bsr['total number of downloads'] = np.sum(downloads_ref_totals or [0], dtype=int)
     # Get the average number of downloads
@@ -263,36 +517,80 @@ def get_basic_stats(identifiers):
     # Get the median number of downloads
     bs['median number of downloads'] = np.median(downloads_totals or [0])
     bsr['median number of downloads'] = np.median(downloads_ref_totals or [0])
-    # Get the normalized number of downloads
-    # bs['normalized number of downloads'] = \
-    # np.sum([np.array(p.downloads)/float(p.author_num) for p in data if
-    # p.downloads and len(p.downloads) == Nentries])
-    # bsr['normalized number of downloads'] = \
-    # np.sum([np.array(p.downloads)/float(p.author_num) for p in data if
-    # p.refereed and p.downloads and len(p.downloads) == Nentries])
     # and finally, get the recent number of downloads
-    bs['recent number of downloads'] = sum(
-        [p.downloads[-1] for p in data if p.downloads and
-         len(p.downloads) == Nentries])
-    bsr['recent number of downloads'] = sum(
-        [p.downloads[-1] for p in data if p.refereed and p.downloads and
-         len(p.downloads) == Nentries])
+    bs['recent number of downloads'] = int(downloads.usage[:, -1].sum())
+    bsr['recent number of downloads'] = int(
+        downloads.usage[downloads.refereed, -1].sum())
     # Return both results and the data (which will get used later on
     # if the usage histograms are required)
     return bs, bsr, data
 
+# The same statistics, from the per-record totals in the metrics_summary
+# table
+
+
+def get_summary_stats(identifiers, data):
+    bs = {}
+    bsr = {}
+    bs['number of papers'] = len(identifiers)
+    bsr['number of papers'] = len([p for p in data if p.refereed])
+    bs['normalized paper count'] = np.sum(
+        np.array([1.0 / float(p.author_num) for p in data]), dtype=float)
+    bsr['normalized paper count'] = np.sum(
+        np.array([1.0 / float(p.author_num) for p in data if p.refereed]), dtype=float)
+    # Only records with usage for every year since 1996 are considered
+    year = datetime.now().year
+    Nentries = year - 1996 + 1
+    reads = [p for p in data if p.reads_length == Nentries]
+    reads_ref = [p for p in reads if p.refereed]
+    reads_totals = [p.reads_total for p in reads]
+    reads_ref_totals = [p.reads_total for p in reads_ref]
+    bs['total number of reads'] = np.sum(reads_totals or [0], dtype=int)
+    bsr['total number of reads'] = np.sum(reads_ref_totals or [0], dtype=int)
+    try:
+        bs['average number of reads'] = float(bs['total number of reads'])/float(bs['number of papers'])
+    except:
+        bs['average number of reads'] = 0.0
+    try:
+        bsr['average number of reads'] = float(bsr['total number of reads'])/float(bsr['number of papers'])
+    except:
+        bsr['average number of reads'] = 0.0
+    bs['median number of reads'] = np.median(reads_totals or [0])
+    bsr['median number of reads'] = np.median(reads_ref_totals or [0])
+    bs['recent number of reads'] = sum([p.reads_recent for p in reads])
+    bsr['recent number of reads'] = sum([p.reads_recent for p in reads_ref])
+    downloads = [p for p in data if p.downloads_length == Nentries]
+    downloads_ref = [p for p in downloads if p.refereed]
+    downloads_totals = [p.downloads_total for p in downloads]
+    downloads_ref_totals = [p.downloads_total for p in downloads_ref]
+    bs['total number of downloads'] = np.sum(downloads_totals or [0], dtype=int)
+    bsr['total number of downloads'] = np.sum(downloads_ref_totals or [0], dtype=int)
+    bs['average number of downloads'] = np.mean(downloads_totals or [0], dtype=float)
+    bsr['average number of downloads'] = np.mean(downloads_ref_totals or [0], dtype=float)
+    bs['median number of downloads'] = np.median(downloads_totals or [0])
+    bsr['median number of downloads'] = np.median(downloads_ref_totals or [0])
+    bs['recent number of downloads'] = sum(
+        [p.downloads_recent for p in downloads])
+    bsr['recent number of downloads'] = sum(
+        [p.downloads_recent for p in downloads_ref])
+    return bs, bsr
+
 # The citation stats function gets statistics for citations
 
 
-def get_citation_stats(identifiers, bibcodes, bibcodes_ref):
-    data = selfcits = citdata = None
+def get_citation_stats(identifiers, bibcodes, bibcodes_ref, data=None):
+    selfcits = citdata = None
     # citation stats for all publications
     cs = {}
     # citation stats for refereed publications
     csr = {}
     # Get the data to compute the citation statistics
     # First get data with just the numbers
-    data = get_citation_data(identifiers)
+    if data is None:
+        data = get_citation_data(identifiers)
+        citdata = None
+    else:
+        citdata = data
     Nzero = len(bibcodes) - len(data)
     Nzero_ref = len(bibcodes_ref) - \
         len([p.citation_num for p in data if p.refereed])
@@ -311,13 +609,12 @@ def get_citation_stats(identifiers, bibcodes, bibcodes_ref):
     # Nciting    : number of citing papers
     # Nciting_ref: number of citing papers for refereed publications
     citdata, selfcits, Nself, Nself_ref, Nciting, Nciting_ref = \
-        get_selfcitations(identifiers, bibcodes)
+        get_selfcitations(identifiers, bibcodes, data=citdata)
     # The number of unique citing papers and the number of self-citations
     cs['number of citing papers'] = Nciting
     csr['number of citing papers'] = Nciting_ref
     cs['number of self-citations'] = Nself
-    self_citations = list(itertools.chain(*[list(e[0]) for e in selfcits if len(e[0]) > 0]))
-    cs['self-citations'] = self_citations
+    cs['self-citations'] = get_selfcitation_list(selfcits)
     csr['number of self-citations'] = Nself_ref
     # The citation stats
     # Total number of citations
@@ -359,11 +656,12 @@ def get_citation_stats(identifiers, bibcodes, bibcodes_ref):
     return cs, csr, data, selfcits, citdata
 
 
-def get_publication_histograms(identifiers):
+def get_publication_histograms(identifiers, data=None):
     ph = {}
     current_year = datetime.now().year
-    # Get necessary data
-    data = get_publication_data(identifiers)
+    # Get necessary data if nothing was provided
+    if data is None:
+        data = get_publication_data(identifiers)
     # Get the publication histogram
     years = [int(p.bibcode[:4]) for p in data]
     nullhist = [(y, 0) for y in range(min(years), current_year + 1)]
@@ -381,75 +679,71 @@ def get_publication_histograms(identifiers):
     return ph
 
 
-def get_usage_histograms(identifiers, usage_type='reads', data=None):
+# The usage of the records with reads or downloads for every year since
+# 1996: a matrix with a row per record (in the order of the records), with
+# the bibcodes, refereed flags and number of authors of these records
+UsageMatrix = namedtuple('UsageMatrix',
+                         ['usage', 'bibcodes', 'refereed', 'authors'])
+
+
+def get_usage_matrix(data, usage_type):
+    Nentries = datetime.now().year - 1996 + 1
+    records = [p for p in data if getattr(p, usage_type) and
+               len(getattr(p, usage_type)) == Nentries]
+    usage = np.array([getattr(p, usage_type) for p in records],
+                     dtype=np.int64).reshape(-1, Nentries)
+    bibcodes = [p.bibcode for p in records]
+    refereed = np.array([bool(p.refereed) for p in records], dtype=bool)
+    authors = np.array([float(p.author_num) for p in records], dtype=float)
+    return UsageMatrix(usage, bibcodes, refereed, authors)
+
+
+def get_usage_histograms(identifiers, usage_type='reads', data=None,
+                         usage=None):
     uh = {}
+    if usage_type != 'reads':
+        usage_type = 'downloads'
     # Get necessary data if nothing was provided
-    if not data:
-        data = get_usage_data(identifiers)
+    if usage is None:
+        if data is None:
+            data = get_usage_data(identifiers)
+        usage = get_usage_matrix(data, usage_type)
     # Determine the current year (so that we know how many entries to expect
     # in usage lists)
     year = datetime.now().year
     Nentries = year - 1996 + 1
-    zeros = [[0] * Nentries]
-    if usage_type == 'reads':
-        # Get all reads data and sum up the individual lists
-        usage_data = [
-            p.reads for p in data if p.reads and len(p.reads) == Nentries]
-        usage = [sum(sublist)
-                 for sublist in zip(*usage_data or zeros)]
-        # and also get the normalized reads
-        usage_data = [np.array(p.reads, dtype=int) / float(p.author_num)
-                      for p in data if p.reads and len(p.reads) == Nentries]
-        usage_norm = [sum(sublist)
-                      for sublist in zip(*usage_data or zeros)]
-        # Do the same for just the refereed publications
-        usage_data = [p.reads for p in data if p.refereed and p.reads and
-                      len(p.reads) == Nentries]
-        usage_ref = [sum(sublist)
-                     for sublist in zip(*usage_data or zeros)]
-        # and also get the normalized version
-        usage_data = [np.array(p.reads, dtype=int) / float(p.author_num)
-                      for p in data if p.refereed and p.reads and
-                      len(p.reads) == Nentries]
-        usage_ref_norm = [sum(sublist)
-                          for sublist in zip(*usage_data or zeros)]
-    else:
-        usage_type = 'downloads'
-        # Get all downloads data and sum up the individual lists
-        usage_data = [
-            p.downloads for p in data if p.downloads and
-            len(p.downloads) == Nentries]
-        usage = [sum(sublist)
-                 for sublist in zip(*usage_data or zeros)]
-        # and also get the normalized version
-        usage_data = [np.array(p.downloads, dtype=int) / float(p.author_num)
-                      for p in data if p.downloads and
-                      len(p.downloads) == Nentries]
-        usage_norm = [sum(sublist)
-                      for sublist in zip(*usage_data or zeros)]
-        # Do the same for just the refereed publications
-        usage_data = [p.downloads for p in data if p.refereed and
-                      p.downloads and len(p.downloads) == Nentries]
-        usage_ref = [sum(sublist)
-                     for sublist in zip(*usage_data or zeros)]
-        # and also get the normalized version
-        usage_data = [np.array(p.downloads, dtype=int) / float(p.author_num)
-                      for p in data if p.refereed and p.downloads and
-                      len(p.downloads) == Nentries]
-        usage_ref_norm = [sum(sublist)
-                          for sublist in zip(*usage_data or zeros)]
-        # Construct the histograms (index 0 corresponds with year 1996)
+
+    def totals(m):
+        # The usage per year (index 0 corresponds with year 1996), summed
+        # in the order of the records
+        return m.sum(axis=0).tolist() if len(m) else [0] * Nentries
+
+    # The normalized usage divides the usage of every record by its number
+    # of authors
+    normalized = usage.usage / usage.authors[:, None]
     uh['all %s' % usage_type] = dict(
-        [(1996 + i, v) for i, v in enumerate(usage)])
+        [(1996 + i, v) for i, v in enumerate(totals(usage.usage))])
     uh['all %s normalized' % usage_type] = dict(
-        [(1996 + i, v) for i, v in enumerate(usage_norm)])
+        [(1996 + i, v) for i, v in enumerate(totals(normalized))])
     uh['refereed %s' % usage_type] = dict(
-        [(1996 + i, v) for i, v in enumerate(usage_ref)])
+        [(1996 + i, v) for i, v in enumerate(totals(usage.usage[usage.refereed]))])
     uh['refereed %s normalized' % usage_type] = dict(
-        [(1996 + i, v) for i, v in enumerate(usage_ref_norm)])
+        [(1996 + i, v) for i, v in enumerate(totals(normalized[usage.refereed]))])
     return uh
 
 
+def has_citation_years(data):
+    # Whether the citation counts per year are available for all records
+    return all(getattr(p, 'refereed_citation_years', None) is not None
+               for p in data)
+
+
+def has_citation_ids(data):
+    # Whether the citations are available as bibcode identifiers for all
+    # records
+    return all(getattr(p, 'citation_ids', None) is not None for p in data)
+
+
 def get_citation_histograms(identifiers, data=None):
     ch = {}
     current_year = datetime.now().year
@@ -459,62 +753,187 @@ def get_citation_histograms(identifiers, data=None):
     if len(data) == 0:
         data = get_citations(identifiers, no_zero=False)
     years = [int(p.bibcode[:4]) for p in data]
-    # First gather all necessary data
-    # refereed -> refereed
-    rr_data = [([int(c[:4]) for c in p.refereed_citations],
-                1.0 / float(p.author_num)) for p in data if p.refereed]
-    # refereed -> non-refereed
-    rn_data = [([int(c[:4]) for c in p.citations if c in p.refereed_citations],
-                1.0 / float(p.author_num)) for p in data if not p.refereed]
-    # non-refereed -> refereed
-    nr_data = [([int(c[:4]) for c in list(set(p.citations).difference(
-        set(p.refereed_citations)))], 1.0 / float(p.author_num)) for
-        p in data if p.refereed]
-    # non-refereed -> non-refereed
-    nn_data = [([int(c[:4]) for c in p.citations if
-                 c not in p.refereed_citations],
-                1.0 / float(p.author_num)) for p in data if not p.refereed]
-    # First construct the regular histograms
-    max_year = current_year
-    rr_hist = cy.frequencies(list(itertools.chain(*[d[0] for d in rr_data])))
-    rn_hist = cy.frequencies(list(itertools.chain(*[d[0] for d in rn_data])))
-    nr_hist = cy.frequencies(list(itertools.chain(*[d[0] for d in nr_data])))
-    nn_hist = cy.frequencies(list(itertools.chain(*[d[0] for d in nn_data])))
+    # First gather all necessary data: the citation years of the
+    # refereed -> refereed, refereed -> non-refereed, non-refereed ->
+    # refereed and non-refereed -> non-refereed citations
+    if has_citation_years(data):
+        # From the precomputed counts, which are classified the same way
+        categories = get_citation_year_categories(data)
+    elif has_citation_ids(data):
+        categories = get_citation_id_data(data)
+    else:
+        categories = get_citation_categories(data)
+    return citation_histograms(ch, current_year, years, *categories)
+
+
+def get_citation_year_categories(data):
+    """
+    The citation years (with the normalization of their records) of the
+    four categories of citations, from the citation counts per year
+    """
+    def expand(records, refereed):
+        counts = [p.refereed_citation_years if refereed else
+                  p.nonrefereed_citation_years for p in records]
+        records = [(p, c) for p, c in zip(records, counts) if len(c)]
+        lengths = np.array([len(c) for p, c in records], dtype=np.int64)
+        steps = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        starts = np.array([p.citation_years_start for p, c in records],
+                          dtype=np.int64)
+        norms = np.array([1.0 / float(p.author_num) for p, c in records],
+                         dtype=float)
+        counts = np.array(list(itertools.chain(*[c for p, c in records])),
+                          dtype=np.int64)
+        return (np.repeat(np.repeat(starts, lengths) + steps, counts),
+                np.repeat(np.repeat(norms, lengths), counts))
+
+    refereed = [p for p in data if p.refereed]
+    nonrefereed = [p for p in data if not p.refereed]
+    return (expand(refereed, True), expand(nonrefereed, True),
+            expand(refereed, False), expand(nonrefereed, False))
+
+
+def get_citation_id_data(data):
+    """
+    The citation years (with the normalization of their records) of the
+    four categories of citations, from the citations as bibcode identifiers
+    """
+    citations = [as_ids(p.citation_ids) for p in data]
+    refereed_citations = [as_ids(p.refereed_citation_ids) for p in data]
+    return citation_categories(
+        data, citations, refereed_citations,
+        bibcode_years(np.concatenate(citations + [as_ids([])])),
+        bibcode_years(np.concatenate(refereed_citations + [as_ids([])])))
+
+
+def get_citation_categories(data):
+    """
+    The citation years (with the normalization of their records) of the
+    four categories of citations, from the citing bibcodes. The bibcodes
+    are numbered (with the same number for the same bibcode), so that they
+    can be classified like bibcode identifiers.
+    """
+    citations = [list(p.citations) for p in data]
+    refereed_citations = [list(p.refereed_citations) for p in data]
+    bibcodes = list(itertools.chain(*citations)) + \
+        list(itertools.chain(*refereed_citations))
+    years = get_citing_years(bibcodes)
+    index = dict(zip(dict.fromkeys(bibcodes), itertools.count()))
+    numbers = np.fromiter(map(index.__getitem__, bibcodes), dtype=np.int64,
+                          count=len(bibcodes))
+    n = sum([len(c) for c in citations])
+    split = np.cumsum([len(c) for c in citations])[:-1]
+    refsplit = np.cumsum([len(c) for c in refereed_citations])[:-1]
+    return citation_categories(
+        data, np.split(numbers[:n], split), np.split(numbers[n:], refsplit),
+        years[:n], years[n:])
+
+
+def get_citing_years(bibcodes):
+    # The years of citing bibcodes, from the digits of their first four
+    # bytes (bibcodes that do not start with four digits are converted one
+    # by one, like before)
+    try:
+        prefixes = np.array(bibcodes, dtype='S4')
+        digits = prefixes.view(np.uint8).reshape(-1, 4).astype(np.int64) - 48
+        if ((digits >= 0) & (digits <= 9)).all():
+            return digits.dot([1000, 100, 10, 1])
+    except UnicodeEncodeError:
+        pass
+    return np.array([int(c[:4]) for c in bibcodes], dtype=np.int64)
+
+
+def citation_categories(data, citations, refereed_citations, cityears,
+                        refcityears):
+    """
+    Classify the citations of records (as numbers per record) in the four
+    categories of citations, as in get_citation_histograms: the refereed
+    citations of refereed records, the citations of non-refereed records
+    that are refereed citations, the distinct other citations of refereed
+    records and the other citations of non-refereed records. Every
+    category is returned as its citation years with the normalization of
+    their records.
+    """
+    norms = np.array([1.0 / float(p.author_num) for p in data], dtype=float)
+    refereed = np.array([bool(p.refereed) for p in data], dtype=bool)
+    records = np.repeat(np.arange(len(data)), [len(c) for c in citations])
+    refrecords = np.repeat(np.arange(len(data)),
+                           [len(c) for c in refereed_citations])
+    citations = np.concatenate(list(citations) + [as_ids([])])
+    refereed_citations = np.concatenate(list(refereed_citations) + [as_ids([])])
+    # Sort the citations and refereed citations by record and citation (with
+    # the refereed citations first), so that every citation can be looked up
+    # in the refereed citations of its record
+    n = len(citations)
+    keys = np.concatenate([records, refrecords])
+    values = np.concatenate([citations, refereed_citations])
+    kinds = np.concatenate([np.ones(n, dtype=np.int8),
+                            np.zeros(len(refereed_citations), dtype=np.int8)])
+    order = np.lexsort((kinds, values, keys))
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (keys[order][1:] != keys[order][:-1]) | \
+        (values[order][1:] != values[order][:-1])
+    groups = np.cumsum(starts) - 1
+    group_refereed = kinds[order][starts] == 0
+    in_refereed = np.zeros(len(order), dtype=bool)
+    in_refereed[order] = group_refereed[groups]
+    # The first occurrence of every citation (for the distinct citations;
+    # citations that are not refereed citations come first in their group)
+    first = np.zeros(len(order), dtype=bool)
+    first[order] = starts
+    in_refereed = in_refereed[:n]
+    first = first[:n]
+    cited_refereed = refereed[records]
+    rr = refereed[refrecords]
+    rn = ~cited_refereed & in_refereed
+    nr = cited_refereed & ~in_refereed & first
+    nn = ~cited_refereed & ~in_refereed
+    return ((refcityears[rr], norms[refrecords[rr]]),
+            (cityears[rn], norms[records[rn]]),
+            (cityears[nr], norms[records[nr]]),
+            (cityears[nn], norms[records[nn]]))
+
+
+def citation_histograms(ch, current_year, years, rr_data, rn_data, nr_data,
+                        nn_data):
+    """
+    The citation histograms from the citation years of the four categories
+    of citations, with the normalization of their records. The citations are
+    counted (and their normalizations summed, in the order of the
+    citations) per year with bincount.
+    """
+    categories = [rr_data, rn_data, nr_data, nn_data]
+    cityears = np.concatenate([c[0] for c in categories])
     # From the years of the citations, determine the maximum
-    cityears = list(dict(rr_hist).keys()) + list(dict(rn_hist).keys()) + list(dict(nr_hist).keys()) + list(dict(nn_hist).keys())
-    max_year = max(cityears or [0])
+    max_year = cityears.max() if len(cityears) else 0
     # If this year lies in the future, set the "current year" to that year
     if max_year > current_year:
-        current_year = max_year
+        current_year = int(max_year)
     # Get the earliest citation
-    try:
-        min_year = min(cityears)
-        nullhist = [(y, 0) for y in range(min_year, current_year + 1)]
-    except:
-        nullhist = [(y, 0) for y in range(min(years), current_year + 1)]
-    if len(nullhist) == 0:
-        nullhist = [(min(years), 0)]
+    if len(cityears):
+        nullyears = list(range(int(cityears.min()), current_year + 1))
+    else:
+        nullyears = list(range(min(years), current_year + 1))
+    if len(nullyears) == 0:
+        nullyears = [min(years)]
+    # The normalized histograms run up to the current year
+    normyears = list(range(nullyears[0], current_year + 1))
+    names = ['refereed to refereed', 'refereed to nonrefereed',
+             'nonrefereed to refereed', 'nonrefereed to nonrefereed']
+    counts = []
+    sums = []
+    for cyears, norms in categories:
+        bins = cyears - nullyears[0]
+        counts.append(np.bincount(bins, minlength=len(nullyears)).tolist())
+        sums.append(np.bincount(bins, weights=norms,
+                                minlength=len(nullyears)).tolist())
     # Now create the histograms with zeroes for year without values
-    ch['refereed to refereed'] = merge_dictionaries(dict(nullhist), rr_hist)
-    ch['refereed to nonrefereed'] = merge_dictionaries(dict(nullhist), rn_hist)
-    ch['nonrefereed to refereed'] = merge_dictionaries(dict(nullhist), nr_hist)
-    ch['nonrefereed to nonrefereed'] = merge_dictionaries(
-        dict(nullhist), nn_hist)
-    min_year = min(list(ch['refereed to refereed'].keys()) +
-                   list(ch['refereed to nonrefereed'].keys()) +
-                   list(ch['nonrefereed to refereed'].keys()) +
-                   list(ch['nonrefereed to nonrefereed'].keys()))
-    nullhist = [(y, 0) for y in range(min_year, current_year + 1)]
-    # Normalized histograms need a different approach
-    tmp = list(itertools.chain(*[[(d, x[1]) for d in x[0]] for x in rr_data]))
-    ch['refereed to refereed normalized'] = get_norm_histo(nullhist + tmp)
-    tmp = list(itertools.chain(*[[(d, x[1]) for d in x[0]] for x in rn_data]))
-    ch['refereed to nonrefereed normalized'] = get_norm_histo(nullhist + tmp)
-    tmp = list(itertools.chain(*[[(d, x[1]) for d in x[0]] for x in nr_data]))
-    ch['nonrefereed to refereed normalized'] = get_norm_histo(nullhist + tmp)
-    tmp = list(itertools.chain(*[[(d, x[1]) for d in x[0]] for x in nn_data]))
-    ch['nonrefereed to nonrefereed normalized'] = get_norm_histo(
-        nullhist + tmp)
+    for name, c in zip(names, counts):
+        ch[name] = dict(zip(nullyears, c))
+    # Years without citations have a normalized value of 0 as well
+    for name, c, w in zip(names, counts, sums):
+        ch['%s normalized' % name] = dict(
+            [(y, v if n else 0) for y, n, v in zip(normyears, c, w)])
     return ch
 
 
@@ -522,9 +941,9 @@ def get_indicators(identifiers, data=None, usagedata=None):
     ind = {}
     ind_ref = {}
     # Get the necessary data if we did not get any
-    if not data:
+    if data is None:
         data = get_indicator_data(identifiers)
-    if not usagedata:
+    if usagedata is None:
         usagedata = get_usage_data(identifiers)
     # Organize the citations with a running index (the citation
     # data is already ordered from most to least cited)
@@ -594,29 +1013,35 @@ def get_indicators(identifiers, data=None, usagedata=None):
     # Send results back
     return ind, ind_ref
 
-def get_tori(identifiers, bibcodes, self_cits=None):
+def get_tori(identifiers, bibcodes, self_cits=None, data=None):
     # Get additional data necessary for Tori calculation
-    data = get_tori_data(identifiers)
+    citdata = data
+    if data is None:
+        data = get_tori_data(identifiers)
     if len(data) == 0:
         return 0, 0, 0, 0, []
     # If we did not get self-citations, retrieve them
     if not self_cits:
-        self_cits = get_selfcitations(identifiers, bibcodes)[1]
-    self_citations = set((itertools.chain(*[x[0] for x in self_cits])))
+        self_cits = get_selfcitations(identifiers, bibcodes, data=citdata)[1]
+    self_citations = set(self_cits.self_citations)
     # Now we can calculate the Tori index
-    tori_data = [p for p in list(itertools.chain(
-        *[p.rn_citation_data for p in data if p.rn_citation_data])) if
-        p['bibcode'] not in self_citations and 'pubyear' in p]
-    tori_data_ref = [p for p in list(itertools.chain(
-        *[p.rn_citation_data for p in data if p.refereed and
-            p.rn_citation_data])) if p['bibcode'] not in self_citations]
-    try:
-        tori = np.sum(
-            np.array([r['auth_norm'] * r['ref_norm'] for r in tori_data]), dtype=float)
-        tori_ref = np.sum(
-            np.array([r['auth_norm'] * r['ref_norm'] for r in tori_data_ref]), dtype=float)
-    except:
-        return 0, 0, 0, 0, tori_data
+    if has_tori_arrays(data):
+        tori, tori_ref, tori_data = get_tori_arrays(
+            get_selfcitation_ids(self_cits), data)
+    else:
+        tori_data = [p for p in list(itertools.chain(
+            *[p.rn_citation_data for p in data if p.rn_citation_data])) if
+            p['bibcode'] not in self_citations and 'pubyear' in p]
+        tori_data_ref = [p for p in list(itertools.chain(
+            *[p.rn_citation_data for p in data if p.refereed and
+                p.rn_citation_data])) if p['bibcode'] not in self_citations]
+        try:
+            tori = np.sum(
+                np.array([r['auth_norm'] * r['ref_norm'] for r in tori_data]), dtype=float)
+            tori_ref = np.sum(
+                np.array([r['auth_norm'] * r['ref_norm'] for r in tori_data_ref]), dtype=float)
+        except:
+            return 0, 0, 0, 0, tori_data
     # The riq index follows from the Tori index and the year range
     #yrange = datetime.now().year - min([int(b[:4]) for b in bibcodes]) + 1
     yrange = max([int(b[:4]) for b in bibcodes]) - min([int(b[:4]) for b in bibcodes]) + 1
@@ -629,8 +1054,44 @@ def get_tori(identifiers, bibcodes, self_cits=None):
     # Send the results back
     return tori, tori_ref, riq, riq_ref, tori_data
 
+# The Tori entries (without self-citations and entries without publication
+# year) as arrays
+ToriData = namedtuple('ToriData', ['pubyears', 'cityears', 'weights'])
+
+
+def has_tori_arrays(data):
+    # Whether the Tori arrays are available for all records
+    return all(getattr(p, 'tori_weights', None) is not None for p in data)
+
+
+def get_tori_arrays(self_citation_ids, data):
+    """
+    The Tori, refereed Tori and Tori entries (as ToriData) from the Tori
+    arrays of the records: the same entries are selected as from
+    rn_citation_data, with masks (the self-citations are given as bibcode
+    identifiers)
+    """
+    ids = np.concatenate([as_ids([])] + [as_ids(p.tori_ids) for p in data])
+    pubyears = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+        np.asarray(p.tori_pubyears, dtype=np.int64) for p in data])
+    cityears = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+        np.asarray(p.tori_cityears, dtype=np.int64) for p in data])
+    weights = np.concatenate([np.zeros(0, dtype=float)] + [
+        np.asarray(p.tori_weights, dtype=float) for p in data])
+    refereed = np.concatenate([np.zeros(0, dtype=bool)] + [
+        np.full(len(p.tori_weights), bool(p.refereed)) for p in data])
+    keep = ~np.isin(ids, self_citation_ids)
+    # A publication year of 0 means that it is missing
+    mask = keep & (pubyears != 0)
+    tori = np.sum(weights[mask], dtype=float)
+    tori_ref = np.sum(weights[keep & refereed], dtype=float)
+    return tori, tori_ref, ToriData(pubyears[mask], cityears[mask],
+                                    weights[mask])
+
+
 def get_time_series(identifiers, bibcodes, data=None, usagedata=None,
-                    tori_data=None, include_tori=True, self_cits=None):
+                    tori_data=None, include_tori=True, self_cits=None,
+                    usage=None):
     series = {}
     i10 = {}
     i100 = {}
@@ -639,20 +1100,19 @@ def get_time_series(identifiers, bibcodes, data=None, usagedata=None,
     r10 = {}
     tori = {}
     # Get data if nothing was supplied
-    if not data:
+    if data is None:
         data = get_citations(identifiers)
-    if not usagedata:
+    if usagedata is None:
         usagedata = get_usage_data(identifiers)
-    if not self_cits and include_tori:
-        self_cits = get_selfcitations(identifiers, bibcodes)[1]
-        self_citations = set((itertools.chain(*[x[0] for x in self_cits])))
-    if not tori_data and include_tori:
+    if tori_data is None and include_tori:
+        if not self_cits:
+            self_cits = get_selfcitations(identifiers, bibcodes)[1]
+        self_citations = set(self_cits.self_citations)
         tdata = get_tori_data(identifiers)
         tori_data = [p for p in list(itertools.chain(
             *[p.rn_citation_data for p in tdata if p.rn_citation_data])) if
             p['bibcode'] not in self_citations and 'pubyear' in p]
     # Determine the year range
-    Nentries = datetime.now().year - 1996 + 1
     years = [int(b[:4]) for b in bibcodes]
     yrange = list(range(min(years), datetime.now().year + 1))
     d0 = date(datetime.now().year, 1, 1)
@@ -664,34 +1124,32 @@ def get_time_series(identifiers, bibcodes, data=None, usagedata=None,
        r10_corr = float(ndays)/float(delta)
     except:
        r10_corr = 1.0
-    for year in yrange:
-        biblist = [b for b in bibcodes if int(b[:4]) <= year]
-        citations = sorted([len([int(c[:4]) for c in p.citations if int(
-            c[:4]) <= year]) for p in data if
-            p.bibcode in biblist], reverse=True)
-        if year < 1996:
-            r10[year] = 0.0
-        else:
-            idx = year - 1996
-            r10[year] = sum([float(p.reads[idx]) / float(p.author_num) for
-                             p in usagedata if p.bibcode in biblist and int(
-                p.bibcode[:4]) > year - 10 and p.reads and
-                len(p.reads) == Nentries])
-        try:
-            h[year] = max([i for i, n in enumerate(citations, 1) if i <= n])
-            g[year] = max(
-                [i for i, n in enumerate(np.cumsum(citations, axis=0), 1) if
-                 i**2 <= n])
-        except:
-            h[year] = 0
-            g[year] = 0
-        i10[year] = len([c for c in citations if c >= 10])
-        i100[year] = len([c for c in citations if c >= 100])
-        if include_tori:
-            tori[year] = np.sum(np.array([r['auth_norm'] * r['ref_norm'] for
-                                          r in tori_data if
-                                          r['pubyear'] <= year and
-                                          r['cityear'] <= year]))
+    # The h, g, i10 and i100 indices of all years, from the citations of
+    # the records up to every year (a record counts from its publication
+    # year on)
+    pubyears = dict((b, int(b[:4])) for b in bibcodes)
+    included = np.array([pubyears.get(p.bibcode, yrange[-1] + 1 if yrange else 0)
+                         for p in data], dtype=np.int64)[:, None] <= \
+        np.array(yrange, dtype=np.int64)[None, :]
+    if yrange:
+        citations = get_cumulative_citations(data, yrange[0], yrange[-1])
+    else:
+        citations = np.zeros((len(data), 0), dtype=np.int64)
+    indices = get_citation_index_series(citations, included)
+    if usage is None:
+        usage = get_usage_matrix(usagedata, 'reads')
+    read10 = get_read10_series(usage, pubyears, yrange)
+    if include_tori and not isinstance(tori_data, ToriData):
+        tori_data = ToriData(
+            np.array([r['pubyear'] for r in tori_data], dtype=np.int64),
+            np.array([r['cityear'] for r in tori_data], dtype=np.int64),
+            np.array([r['auth_norm'] * r['ref_norm'] for r in tori_data],
+                     dtype=float))
+    if include_tori:
+        tori = dict(zip(yrange, get_tori_series(tori_data, yrange)))
+    for n, year in enumerate(yrange):
+        r10[year] = read10[n]
+        h[year], g[year], i10[year], i100[year] = [x[n] for x in indices]
     # When all papers are from next year, the following would fail,
     # and therefore we just skip it
     try:
@@ -708,36 +1166,313 @@ def get_time_series(identifiers, bibcodes, data=None, usagedata=None,
 
     return series
 
+def get_cumulative_citations(data, first_year, last_year):
+    """
+    The number of citations of every record up to and including every year
+    from first_year to last_year, as a matrix with a row per record. The
+    citations are counted per record and year with one bincount, and
+    accumulated over the years.
+    """
+    Nyears = last_year - first_year + 1
+    cityears, positions, counts = get_citation_year_arrays(data, False)
+    # Earlier citations count from the first year on
+    keep = cityears <= last_year
+    bins = positions[keep] * Nyears + \
+        np.maximum(cityears[keep] - first_year, 0)
+    citations = np.bincount(bins, weights=counts[keep],
+                            minlength=len(data) * Nyears)
+    return np.cumsum(citations.astype(np.int64).reshape(len(data), Nyears),
+                     axis=1)
+
+
+def get_citation_index_series(citations, included):
+    """
+    The h, g, i10 and i100 indices of every year (as lists), from the
+    cumulative citations of the records (as from get_cumulative_citations)
+    and whether the records are included in every year. The citations of
+    every year are ranked with one sort, with the records that are not
+    included at the end.
+    """
+    ranked = -np.sort(-np.where(included, citations, -1), axis=0)
+    ranks = np.arange(1, len(ranked) + 1)[:, None]
+    valid = ranks <= included.sum(axis=0)
+    h = np.count_nonzero((ranked >= ranks) & valid, axis=0)
+    cumulative = np.cumsum(np.maximum(ranked, 0), axis=0)
+    g = np.where((ranks ** 2 <= cumulative) & valid, ranks, 0).max(
+        axis=0, initial=0)
+    i10 = np.count_nonzero(included & (citations >= 10), axis=0)
+    i100 = np.count_nonzero(included & (citations >= 100), axis=0)
+    return h.tolist(), g.tolist(), i10.tolist(), i100.tolist()
+
+
+def get_read10_series(usage, pubyears, years):
+    """
+    The read10 of every year (as a list), from the reads matrix (as from
+    get_usage_matrix) and the publication years of the bibcodes: the reads
+    of the records published in the last ten years, normalized by their
+    number of authors. All years are summed with one masked reduction of
+    the reads matrix.
+    """
+    # Records that are not among the bibcodes are never included
+    pubyear = np.array([pubyears.get(b, 0) for b in usage.bibcodes],
+                       dtype=np.int64)[:, None]
+    usage_years = np.array([y for y in years if y >= 1996], dtype=np.int64)
+    selected = (pubyear <= usage_years) & (pubyear > usage_years - 10)
+    reads = usage.usage[:, usage_years - 1996] / usage.authors[:, None]
+    totals = np.where(selected, reads, 0.0).sum(axis=0).tolist()
+    # There is no usage before 1996, and a year without any records has a
+    # read10 of 0
+    read10 = [0.0] * (len(years) - len(usage_years))
+    return read10 + [t if n else 0 for t, n in
+                     zip(totals, selected.sum(axis=0).tolist())]
+
+
+def get_tori_series(tori_data, years):
+    """
+    The Tori of every year (as a list) from the Tori entries (as ToriData):
+    the weights are summed in a grid of publication and citation years,
+    which is accumulated over both, so that the Tori of a year is found on
+    the diagonal of the grid.
+    """
+    if not years:
+        return []
+    Nyears = years[-1] - years[0] + 1
+    # Earlier years count from the first year on
+    keep = (tori_data.pubyears <= years[-1]) & (tori_data.cityears <= years[-1])
+    bins = np.maximum(tori_data.pubyears[keep] - years[0], 0) * Nyears + \
+        np.maximum(tori_data.cityears[keep] - years[0], 0)
+    grid = np.bincount(bins, weights=tori_data.weights[keep],
+                       minlength=Nyears * Nyears).reshape(Nyears, Nyears)
+    return np.diagonal(np.cumsum(np.cumsum(grid, axis=0), axis=1)).tolist()
+
+
 def single_citation_report(bibc):
-    histograms = {}
-    current_year = datetime.now().year
-    Nentries = current_year - 1996 + 1
-    zeros = [[0] * Nentries]
     data = get_citations_single(bibc)
+    histograms = report_histograms([bibc], data[:1] or [None])[0]
+    if histograms is None:
+        raise ValueError('No citations found for %s' % bibc)
+    return histograms
+
+
+def citation_reports(bibcodes):
+    """
+    The single citation reports of a list of records, from one retrieval of
+    their data. Returns the reports by bibcode and the list of bibcodes
+    that have no report (because they do not exist or have no citations).
+    """
+    with request_session():
+        records = get_citation_records(bibcodes)
+    found = [b for b in cy.unique(bibcodes) if b in records and b[:4].isdigit()]
+    histograms = report_histograms(found, [records[b] for b in found])
+    reports = dict((b, h) for b, h in zip(found, histograms) if h is not None)
+    skipped = [b for b in bibcodes if b not in reports]
+    return reports, skipped
+
+
+def stream_citation_reports(bibcodes, batch_size=500):
+    """
+    The single citation reports of a list of records as JSON lines, which
+    are generated per batch of batch_size bibcodes. Every line has the
+    report of one record ({bibcode: report}), and the last line has the
+    skipped bibcodes ({'skipped bibcodes': [...]}), so that together they
+    are the same as the result of the detail endpoint.
+    """
+    skipped = []
+    seen = set()
+    for batch in chunks(bibcodes, batch_size):
+        reports, batch_skipped = citation_reports(batch)
+        skipped += batch_skipped
+        for bibc in batch:
+            if bibc in reports and bibc not in seen:
+                seen.add(bibc)
+                yield json.dumps({bibc: reports[bibc]}, cls=MyEncoder) + '\n'
+    yield json.dumps({'skipped bibcodes': skipped}) + '\n'
+
+
+def report_histograms(bibcodes, records):
+    """
+    The histograms of the single citation reports of a list of records (with
+    None for records without citations). The citation years of all records
+    are put in one array, next to the position of the record of every year,
+    and they are counted per record and year with one bincount, in bins
+    from the first citation year of the record up to the current year.
+    """
+    current_year = datetime.now().year
+    N = len(records)
+    cityears, citrecords, citcounts = get_citation_year_arrays(records, False)
+    refcityears, refrecords, refcounts = get_citation_year_arrays(records, True)
+    years = np.concatenate([cityears, refcityears])
+    positions = np.concatenate([citrecords, refrecords])
+    counted = np.bincount(positions, minlength=N) > 0
+    first = np.full(N, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first, positions, years)
+    first[~counted] = current_year
+    last = np.full(N, current_year, dtype=np.int64)
+    np.maximum.at(last, positions, years)
+    width = last - first + 1
+    offsets = np.cumsum(width) - width
+    citcounts = np.bincount(offsets[citrecords] + cityears - first[citrecords],
+                            weights=citcounts, minlength=width.sum())
+    refcounts = np.bincount(offsets[refrecords] + refcityears - first[refrecords],
+                            weights=refcounts, minlength=width.sum())
+    citcounts = citcounts.astype(np.int64).tolist()
+    refcounts = refcounts.astype(np.int64).tolist()
+    counted = np.flatnonzero(counted).tolist()
+    offsets = offsets.tolist()
+    first = first.tolist()
+    last = last.tolist()
+
+    def later_years(years, positions):
+        # The years after the current year per record, in the order they are
+        # cited in
+        later = defaultdict(list)
+        after = years > current_year
+        for y, n in zip(years[after].tolist(), positions[after].tolist()):
+            if y not in later[n]:
+                later[n].append(y)
+        return later
+
+    citlater = later_years(cityears, citrecords)
+    reflater = later_years(refcityears, refrecords)
+    reads = get_usage_lists([records[n] for n in counted], 'reads')
+    downloads = get_usage_lists([records[n] for n in counted], 'downloads')
+
+    results = [None] * N
+    for n, r, d in zip(counted, reads, downloads):
+        histograms = {}
+        start = offsets[n]
+        end = start + max(0, current_year - first[n] + 1)
+        years = range(first[n], current_year + 1)
+        histograms['citations'] = dict(zip(years, citcounts[start:end]))
+        histograms['ref_citations'] = dict(zip(years, refcounts[start:end]))
+        for y in citlater[n]:
+            histograms['citations'][y] = citcounts[start + y - first[n]]
+        for y in reflater[n]:
+            histograms['ref_citations'][y] = refcounts[start + y - first[n]]
+        # Have the histograms start at the publication year
+        start = max(0, int(bibcodes[n][:4]) - 1996)
+        histograms['reads'] = dict(zip(range(1996 + start, 1996 + len(r)),
+                                       r[start:]))
+        histograms['downloads'] = dict(zip(range(1996 + start, 1996 + len(d)),
+                                           d[start:]))
+        results[n] = histograms
+    return results
+
+
+def get_usage_lists(records, column):
+    """
+    The reads or downloads of a list of records as lists of integers, which
+    are converted for all records at once (records without them get a list
+    with a list of zeros, like before)
+    """
+    zeros = [[0] * (datetime.now().year - 1996 + 1)]
+    usage = [getattr(p, column) for p in records]
     try:
-        cityears = [int(b[:4]) for b in data[0].citations]
-    except:
-        cityears = []
-    try:
-        refcityears = [int(b[:4]) for b in data[0].refereed_citations]
-    except:
-        refcityears = []
-    try:
-        reads = [int(r) for r in data[0].reads]
-    except:
-        reads = zeros
-    try:
-        downloads = [int(d) for d in data[0].downloads]
-    except:
-        downloads = zeros
+        values = np.array(list(itertools.chain(
+            *[u for u in usage if u is not None])), dtype=np.int64).tolist()
+    except (TypeError, ValueError, OverflowError):
+        values = None
+    lists = []
+    start = 0
+    for u in usage:
+        if u is None:
+            lists.append(zeros)
+        elif values is None:
+            try:
+                lists.append([int(v) for v in u])
+            except:
+                lists.append(zeros)
+        else:
+            lists.append(values[start:start + len(u)])
+            start += len(u)
+    return lists
 
-    nullhist = [(y, 0) for y in range(min(cityears+refcityears), current_year + 1)]
-    cithist = cy.frequencies(cityears)
-    refcithist = cy.frequencies(refcityears)
-    histograms['citations'] = merge_dictionaries(dict(nullhist), cithist)
-    histograms['ref_citations'] = merge_dictionaries(dict(nullhist), refcithist)
-    # Have the histograms start at the publication year
-    histograms['reads'] = dict([(1996 + i, v) for i, v in enumerate(reads) if 1996+i >= int(bibc[:4])])
-    histograms['downloads'] = dict([(1996 + i, v) for i, v in enumerate(downloads) if 1996+i >= int(bibc[:4])])
 
-    return histograms
+def get_citation_year_arrays(records, refereed):
+    """
+    The years of all citations (or of the refereed citations) of a list of
+    records, as one array next to an array with the position of the record
+    of every year and one with the number of citations in that year. The
+    years of a record are in the order of its citations. The years are
+    extracted per form of the citation data, for all records with that form
+    at once.
+    """
+    # Citation counts per year (first year, number of years, position and
+    # counts), bibcode identifiers and lists of citing bibcodes (with the
+    # positions of their records)
+    counted = ([], [], [], [])
+    identifiers = ([], [])
+    bibcodes = ([], [])
+    for n, p in enumerate(records):
+        if p is None:
+            continue
+        if has_citation_years([p]):
+            # The refereed citations are part of the citations, so together
+            # the refereed and non-refereed citations are all citations
+            counts = [p.refereed_citation_years]
+            if not refereed:
+                counts.append(p.nonrefereed_citation_years)
+            for c in counts:
+                if len(c):
+                    counted[0].append(p.citation_years_start)
+                    counted[1].append(len(c))
+                    counted[2].append(n)
+                    counted[3].extend(c)
+        elif has_citation_ids([p]):
+            ids = p.refereed_citation_ids if refereed else p.citation_ids
+            identifiers[0].extend(ids)
+            identifiers[1].extend([n] * len(ids))
+        else:
+            citations = p.refereed_citations if refereed else p.citations
+            bibcodes[0].append(list(citations) if citations is not None else [])
+            bibcodes[1].append(n)
+    lengths = np.array(counted[1], dtype=np.int64)
+    steps = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,
+                                                  lengths)
+    counts = np.array(counted[3], dtype=np.int64)
+    # Only the years with citations count
+    cited = counts > 0
+    years = [(np.repeat(np.array(counted[0], dtype=np.int64), lengths) + steps)[cited],
+             bibcode_years(identifiers[0])]
+    positions = [np.repeat(np.array(counted[2], dtype=np.int64), lengths)[cited],
+                 np.array(identifiers[1], dtype=np.int64)]
+    counts = [counts[cited], np.ones(len(identifiers[1]), dtype=np.int64)]
+    if bibcodes[0]:
+        y, p = get_bibcode_years(*bibcodes)
+        years.append(y)
+        positions.append(p)
+        counts.append(np.ones(len(y), dtype=np.int64))
+    return np.concatenate(years), np.concatenate(positions), \
+        np.concatenate(counts)
+
+
+def get_bibcode_years(lists, positions):
+    """
+    The years of the bibcodes in lists of bibcodes, with the position of
+    every year. The years are computed from the first four bytes of the
+    bibcodes as digits. Lists with a bibcode that does not start with four
+    digits are converted one bibcode at a time, like before (so that such
+    a list gives no years).
+    """
+    lengths = [len(l) for l in lists]
+    fields = np.repeat(np.arange(len(lists)), lengths)
+    try:
+        prefixes = np.array(list(itertools.chain(*lists)), dtype='S4')
+        digits = prefixes.view(np.uint8).reshape(-1, 4).astype(np.int64) - 48
+        valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+        invalid = np.unique(fields[~valid]).tolist()
+    except UnicodeEncodeError:
+        digits = np.zeros((len(fields), 4), dtype=np.int64)
+        invalid = list(range(len(lists)))
+    keep = ~np.isin(fields, invalid)
+    years = [digits[keep].dot([1000, 100, 10, 1])]
+    positions = np.array(positions, dtype=np.int64)
+    records = [np.repeat(positions, lengths)[keep]]
+    for f in invalid:
+        try:
+            y = [int(b[:4]) for b in lists[f]]
+        except:
+            y = []
+        years.append(np.array(y, dtype=np.int64))
+        records.append(np.repeat(positions[f], len(y)))
+    return np.concatenate(years), np.concatenate(records)
@@ -3,14 +3,22 @@ Created on April 9, 2015
 
 @author: ehenneken
 '''
-from flask import current_app, request
+from flask import current_app, request, g
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import text
 from sqlalchemy import Column, Integer, String, DateTime, Boolean, BigInteger
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.engine.result import ResultProxy
 from sqlalchemy.ext.declarative import declarative_base
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager
 import sys
+import array
+import hashlib
+import itertools
+import re
+import threading
 import psycopg2
 
 Base = declarative_base()
@@ -33,18 +41,288 @@ class MetricsModel(Base):
     rn_citations = Column(postgresql.REAL)
     rn_citation_data = Column(postgresql.JSON)
     modtime = Column(DateTime)
+    # Citation counts per year, maintained by a trigger (see the
+    # add_citation_years migration)
+    citation_years_start = Column(Integer)
+    refereed_citation_years = Column(postgresql.ARRAY(Integer))
+    nonrefereed_citation_years = Column(postgresql.ARRAY(Integer))
+    # The citations as bibcode identifiers (see codec.py), also maintained
+    # by a trigger (see the add_bibcode_dictionary migration)
+    citation_ids = Column(postgresql.ARRAY(BigInteger))
+    refereed_citation_ids = Column(postgresql.ARRAY(BigInteger))
+    # The entries of rn_citation_data as parallel arrays, also maintained by
+    # a trigger (see the add_tori_arrays migration)
+    tori_ids = Column(postgresql.ARRAY(BigInteger))
+    tori_pubyears = Column(postgresql.ARRAY(Integer))
+    tori_cityears = Column(postgresql.ARRAY(Integer))
+    tori_weights = Column(postgresql.ARRAY(postgresql.DOUBLE_PRECISION))
 
-def execute_SQL_query(query):
+class MetricsSummaryModel(Base):
+    # Per-record totals derived from the metrics table (see
+    # refresh_metrics_summary)
+    __tablename__ = 'metrics_summary'
+    id = Column(BigInteger, primary_key=True)
+    bibcode = Column(String, nullable=False)
+    refereed = Column(Boolean, default=False)
+    author_num = Column(Integer, default=1)
+    citation_num = Column(Integer, default=0)
+    refereed_citation_num = Column(Integer, default=0)
+    reads_total = Column(BigInteger, default=0)
+    reads_recent = Column(Integer, default=0)
+    reads_length = Column(Integer, default=0)
+    downloads_total = Column(BigInteger, default=0)
+    downloads_recent = Column(Integer, default=0)
+    downloads_length = Column(Integer, default=0)
+    modtime = Column(DateTime, index=True)
+
+class BibcodeDictionaryModel(Base):
+    __tablename__ = 'bibcode_dictionary'
+    id = Column(BigInteger, primary_key=True)
+    bibcode = Column(String, nullable=False, unique=True)
+
+# Postgres types of the parameters used in the queries below (needed for
+# preparing statements)
+param_types = {'ids': 'bigint[]', 'bibcodes': 'text[]', 'bibcode': 'text',
+               'modtime': 'timestamp'}
+
+def execute_SQL_query(query, params=None):
+    params = params or {}
+    aio = getattr(current_app, 'aio', None)
+    if aio is not None:
+        return aio.execute(query, params)
+    replicas = getattr(current_app, 'replicas', None)
+    if replicas is not None:
+        return replicas.execute(
+            query, params,
+            prepared=current_app.config.get('METRICS_PREPARED_STATEMENTS', False))
+    shared = getattr(g, 'metrics_session', None)
+    if shared is not None:
+        return execute_in_session(shared.get(), query, params)
     with current_app.session_scope() as session:
-        results = session.execute(query).fetchall()
-        return results
+        return execute_in_session(session, query, params)
+
+def execute_in_session(session, query, params):
+    if current_app.config.get('METRICS_PREPARED_STATEMENTS', False):
+        return execute_prepared(session, query, params)
+    return session.execute(text(query), params).fetchall()
+
+class RequestSession(object):
+    """
+    A read-only transaction shared by all queries of a request, which is
+    only started when the first query is executed. With an isolation level
+    of REPEATABLE READ, all queries see the same version of the data, and
+    the transaction snapshot can be exported (see export_snapshot) so that
+    the transactions of parallel chunks see it as well.
+    """
+
+    def __init__(self, isolation=None, snapshot=None):
+        self.isolation = isolation
+        self.snapshot = snapshot
+        self.scope = None
+        self.session = None
+        self.exported = None
+
+    def get(self):
+        if self.session is None:
+            scope = current_app.session_scope()
+            session = scope.__enter__()
+            options = {}
+            if self.isolation:
+                options['isolation_level'] = self.isolation
+            try:
+                session.connection(execution_options=options)
+                if self.snapshot:
+                    session.execute(text("SET TRANSACTION SNAPSHOT :snapshot"),
+                                    {'snapshot': self.snapshot})
+                session.execute(text("SET TRANSACTION READ ONLY"))
+            except:
+                scope.__exit__(*sys.exc_info())
+                raise
+            self.scope = scope
+            self.session = session
+        return self.session
+
+    def export_snapshot(self):
+        if self.exported is None and self.isolation in ('REPEATABLE READ', 'SERIALIZABLE'):
+            self.exported = self.get().execute(
+                text("SELECT pg_export_snapshot()")).scalar()
+        return self.exported
+
+    def close(self):
+        # Nothing was written, so there is nothing to commit
+        if self.session is not None:
+            self.session.rollback()
+            self.scope.__exit__(None, None, None)
+            self.session = self.scope = None
+
+@contextmanager
+def request_session(snapshot=None):
+    """
+    Execute the queries within this block in one read-only transaction
+    (when METRICS_REQUEST_SESSION is set). Nested blocks use the transaction
+    of the outer block.
+    """
+    if not current_app.config.get('METRICS_REQUEST_SESSION', False) or \
+       getattr(g, 'metrics_session', None) is not None:
+        yield
+        return
+    g.metrics_session = RequestSession(
+        current_app.config.get('METRICS_REQUEST_ISOLATION'), snapshot)
+    try:
+        yield
+    finally:
+        session = g.metrics_session
+        g.metrics_session = None
+        session.close()
+
+def execute_prepared(session, query, params):
+    """
+    Execute a query as a server-side prepared statement. Statements are
+    prepared once per database connection and named after the query text,
+    so that Postgres can reuse the plan for subsequent executions.
+    """
+    return execute_prepared_statement(session.connection(), query, params)
+
+def positional_parameters(query, params):
+    """
+    Convert a query with named parameters (:name) to one with positional
+    parameters ($n), and return it with the names of the parameters in the
+    order of their positions (casts like ::text are left alone)
+    """
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in params:
+            return match.group(0)
+        if name not in names:
+            names.append(name)
+        return '$%s' % (names.index(name) + 1)
+
+    statement = re.sub(r'(?<!:):(\w+)\b', replace, query)
+    return statement, names
+
+def execute_prepared_statement(connection, query, params):
+    name = 'metrics_%s' % hashlib.md5(query.encode('utf-8')).hexdigest()[:16]
+    statement, names = positional_parameters(query, params)
+    prepared = connection.info.setdefault('prepared_statements', set())
+    if name not in prepared:
+        types = ",".join([param_types[param] for param in names])
+        if types:
+            types = "(%s)" % types
+        connection.execute(text("PREPARE %s %s AS %s" % (name, types, statement)))
+        prepared.add(name)
+    args = ",".join([':%s' % param for param in names])
+    if args:
+        args = "(%s)" % args
+    return connection.execute(text("EXECUTE %s %s" % (name, args)),
+                              dict((param, params[param]) for param in names)).fetchall()
+
+def chunks(l, n):
+    """
+    Yield successive n-sized chunks from l.
+    """
+    for i in range(0, len(l), n):
+        yield l[i:i + n]
+
+# Thread pool used to retrieve chunks of large requests in parallel (shared by
+# all requests, so that the number of database connections used for this is
+# bounded)
+executor = None
+executor_lock = threading.Lock()
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=current_app.config.get('METRICS_FETCH_THREADS', 4))
+    return executor
+
+def execute_chunked_query(query, param, values, ordered=False):
+    """
+    Execute a query for a list of values (identifiers or bibcodes), which
+    is passed as the parameter 'param'. When the list is larger than
+    METRICS_CHUNK_SIZE, it is split up in chunks that are retrieved in
+    parallel, each with its own database session. The results are combined
+    in the order of the chunks, and ordered by citation_num (descending)
+    again if the query requires this. With the asyncio data layer, the
+    chunks are retrieved concurrently on its event loop instead. Values
+    that occur more than once are only sent once (in the order of their
+    first occurrence), so that no record is retrieved twice.
+    """
+    values = list(dict.fromkeys(values))
+    chunk_size = current_app.config.get('METRICS_CHUNK_SIZE', 0)
+    threads = current_app.config.get('METRICS_FETCH_THREADS', 4)
+    aio = getattr(current_app, 'aio', None)
+    if not chunk_size or len(values) <= chunk_size or \
+       (threads < 2 and aio is None):
+        return execute_SQL_query(query, {param: values})
+    if aio is not None:
+        partials = aio.execute_many([(query, {param: chunk}) for chunk
+                                     in chunks(values, chunk_size)])
+    else:
+        app = current_app._get_current_object()
+        # The chunks are retrieved in transactions of their own, which see
+        # the same data as the request transaction (if any)
+        shared = getattr(g, 'metrics_session', None)
+        snapshot = shared.export_snapshot() if shared is not None else None
+        def fetch(chunk):
+            with app.app_context(), request_session(snapshot=snapshot):
+                return execute_SQL_query(query, {param: chunk})
+        partials = list(get_executor().map(fetch, chunks(values, chunk_size)))
+    results = list(itertools.chain(*partials))
+    if ordered:
+        results.sort(key=lambda r: r.citation_num, reverse=True)
+    return results
+
+def stream_SQL_query(query, params=None, batch_size=1000):
+    """
+    Execute a query with a server-side cursor and yield the results in
+    batches of at most batch_size rows, so that the complete result set
+    never has to be held in memory. Server-side cursors cannot be declared
+    for prepared statements, so these queries are never prepared.
+    """
+    shared = getattr(g, 'metrics_session', None)
+    if shared is not None:
+        for batch in stream_session_query(shared.get(), query, params,
+                                          batch_size):
+            yield batch
+        return
+    with current_app.session_scope() as session:
+        for batch in stream_session_query(session, query, params, batch_size):
+            yield batch
+
+def stream_session_query(session, query, params, batch_size):
+    connection = session.connection().execution_options(stream_results=True)
+    results = connection.execute(text(query), params or {})
+    while True:
+        batch = results.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+
+def get_snapshot():
+    # The current snapshot of the metrics table, if the application uses
+    # snapshots (see snapshot.py)
+    store = getattr(current_app, 'snapshot', None)
+    if store is None:
+        return None
+    return store.get()
 
 def get_identifiers(bibcodes):
-    bibstr = ",".join(["\'%s\'" % a for a in bibcodes])
-    rawSQL = "SELECT id,bibcode,refereed FROM metrics WHERE \
-              bibcode = ANY (ARRAY[%s]) ORDER BY citation_num DESC"
-    SQL = rawSQL % bibstr
-    results = execute_SQL_query(SQL)
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.get_identifiers(bibcodes)
+    index = getattr(current_app, 'bibcode_index', None)
+    if index is not None:
+        results = index.lookup(bibcodes)
+        # The index may still be loading
+        if results is not None:
+            return results
+    SQL = "SELECT id,bibcode,refereed,citation_num FROM metrics WHERE \
+           bibcode = ANY (:bibcodes) ORDER BY citation_num DESC"
+    results = execute_chunked_query(SQL, 'bibcodes', bibcodes, ordered=True)
     # For compatibility with unittests
     try:
         res = [(r[1], r[0], r[2]) for r in results]
@@ -53,77 +331,348 @@ def get_identifiers(bibcodes):
     return res
 
 
-def get_basic_stats_data(IDs):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
-    rawSQL = "SELECT bibcode,refereed,reads,downloads,author_num FROM \
-              metrics WHERE id = ANY (VALUES %s)"
-    SQL = rawSQL % IDstr
+def stream_identifier_data(batch_size=10000):
+    # All bibcodes with their id (for the bibcode index, see index.py)
+    SQL = "SELECT id,bibcode,refereed,modtime FROM metrics"
+    return stream_SQL_query(SQL, batch_size=batch_size)
+
+
+def get_modified_identifiers(modtime):
+    SQL = "SELECT id,bibcode,refereed,modtime FROM metrics \
+           WHERE modtime >= :modtime"
+    results = execute_SQL_query(SQL, {'modtime': modtime})
+    return results
+
+
+def count_identifiers():
+    # The number of records (for the bibcode index, see index.py)
+    SQL = "SELECT count(*) FROM metrics"
     results = execute_SQL_query(SQL)
+    return results[0][0]
+
+
+def get_basic_stats_data(IDs):
+    SQL = "SELECT bibcode,refereed,reads,downloads,author_num FROM \
+           metrics WHERE id = ANY (:ids)"
+    results = execute_chunked_query(SQL, 'ids', IDs)
     return results
 
 
 def get_publication_data(IDs):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
-    rawSQL = "SELECT bibcode,refereed,author_num FROM metrics \
-              WHERE id = ANY (VALUES %s)"
-    SQL = rawSQL % IDstr
-    results = execute_SQL_query(SQL)
+    SQL = "SELECT bibcode,refereed,author_num FROM metrics \
+           WHERE id = ANY (:ids)"
+    results = execute_chunked_query(SQL, 'ids', IDs)
     return results
 
 
 def get_citation_data(IDs):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
-    rawSQL = "SELECT bibcode,refereed,citation_num,refereed_citation_num,\
-              author_num FROM metrics WHERE id = ANY (VALUES %s) AND \
-              citation_num <> 0 ORDER BY citation_num DESC"
-    SQL = rawSQL % IDstr
-    results = execute_SQL_query(SQL)
+    SQL = "SELECT bibcode,refereed,citation_num,refereed_citation_num,\
+           author_num FROM metrics WHERE id = ANY (:ids) AND \
+           citation_num <> 0 ORDER BY citation_num DESC"
+    results = execute_chunked_query(SQL, 'ids', IDs, ordered=True)
     return results
 
 
 def get_citations(IDs, no_zero=True):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
     if no_zero:
-        rawSQL = "SELECT bibcode,refereed,citations,refereed_citations,author_num \
-              FROM metrics WHERE id = ANY (VALUES %s) AND citation_num <> 0"
+        SQL = "SELECT bibcode,refereed,citations,refereed_citations,author_num \
+               FROM metrics WHERE id = ANY (:ids) AND citation_num <> 0"
     else:
-        rawSQL = "SELECT bibcode,refereed,citations,refereed_citations,author_num \
-              FROM metrics WHERE id = ANY (VALUES %s)"
-    SQL = rawSQL % IDstr
-    results = execute_SQL_query(SQL)
+        SQL = "SELECT bibcode,refereed,citations,refereed_citations,author_num \
+               FROM metrics WHERE id = ANY (:ids)"
+    results = execute_chunked_query(SQL, 'ids', IDs)
     return results
 
 
 def get_indicator_data(IDs):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
-    rawSQL = "SELECT bibcode,refereed,citation_num FROM metrics \
-              WHERE id = ANY (VALUES %s) AND citation_num <> 0 \
-              ORDER BY citation_num DESC"
-    SQL = rawSQL % IDstr
-    results = execute_SQL_query(SQL)
+    SQL = "SELECT bibcode,refereed,citation_num FROM metrics \
+           WHERE id = ANY (:ids) AND citation_num <> 0 \
+           ORDER BY citation_num DESC"
+    results = execute_chunked_query(SQL, 'ids', IDs, ordered=True)
     return results
 
 
 def get_usage_data(IDs):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
-    rawSQL = "SELECT bibcode,refereed,reads,downloads,author_num \
-              FROM metrics WHERE id = ANY (VALUES %s) \
-              AND array_length(reads, 1) > 0"
-    SQL = rawSQL % IDstr
-    results = execute_SQL_query(SQL)
+    SQL = "SELECT bibcode,refereed,reads,downloads,author_num \
+           FROM metrics WHERE id = ANY (:ids) \
+           AND array_length(reads, 1) > 0"
+    results = execute_chunked_query(SQL, 'ids', IDs)
     return results
 
 
 def get_tori_data(IDs):
-    IDstr = ",".join(["(%s)" % a for a in IDs])
-    rawSQL = "SELECT id,bibcode,refereed,rn_citation_data,author_num \
-              FROM metrics WHERE id = ANY (VALUES %s) \
-              AND citation_num <> 0"
-    SQL = rawSQL % IDstr
-    results = execute_SQL_query(SQL)
+    SQL = "SELECT id,bibcode,refereed,rn_citation_data,author_num \
+           FROM metrics WHERE id = ANY (:ids) \
+           AND citation_num <> 0"
+    results = execute_chunked_query(SQL, 'ids', IDs)
+    return results
+
+def get_metrics_data(IDs, columns):
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.has_columns(columns):
+        return snapshot.get_records(IDs, columns)
+    cache = getattr(current_app, 'row_cache', None)
+    if cache is not None:
+        results = get_cached_records(cache, 'id', IDs, columns)
+        results.sort(key=lambda r: r.citation_num, reverse=True)
+        return results
+    if current_app.config.get('METRICS_COMPACT_RECORDS', False):
+        batch_size = current_app.config.get('METRICS_COMPACT_BATCH_SIZE', 500)
+        results = []
+        strings = {}
+        for batch in stream_metrics_data(IDs, columns, batch_size=batch_size):
+            results.extend(compact_records(batch, columns, strings))
+        results.sort(key=lambda r: r.citation_num, reverse=True)
+        return results
+    # The column list is assembled from the metrics columns, never from
+    # user input, so it is safe to put it in the query text
+    SQL = "SELECT %s FROM metrics WHERE id = ANY (:ids) \
+           ORDER BY citation_num DESC" % ",".join(columns)
+    results = execute_chunked_query(SQL, 'ids', IDs, ordered=True)
     return results
 
+def stream_metrics_data(IDs, columns, batch_size=1000):
+    # Same as get_metrics_data, but the records are streamed in batches
+    # (in no particular order)
+    SQL = "SELECT %s FROM metrics WHERE id = ANY (:ids)" % ",".join(columns)
+    return stream_SQL_query(SQL, {'ids': list(IDs)}, batch_size=batch_size)
+
+# The numeric array columns that compact records store as arrays, with
+# their type codes
+array_columns = {'reads': 'q', 'downloads': 'q',
+                 'refereed_citation_years': 'q',
+                 'nonrefereed_citation_years': 'q', 'citation_ids': 'q',
+                 'refereed_citation_ids': 'q', 'tori_ids': 'q',
+                 'tori_pubyears': 'q', 'tori_cityears': 'q',
+                 'tori_weights': 'd'}
+
+def compact_records(rows, columns, strings):
+    """
+    Convert a batch of streamed rows to records (as from the row cache) that
+    take less memory than the rows, so that only the rows of one batch are
+    held in memory next to the records of a request: the numeric arrays are stored as
+    arrays instead of lists of numbers, and the citing bibcodes are shared
+    by all records through strings (a dict of the bibcodes seen so far).
+    Arrays with values that do not fit (such as NULLs) are kept as lists.
+    """
+    row_type = get_row_type(columns)
+    records = []
+    for r in rows:
+        values = []
+        for c in columns:
+            value = getattr(r, c)
+            if value is None:
+                pass
+            elif c in array_columns:
+                try:
+                    value = array.array(array_columns[c], value)
+                except (TypeError, OverflowError):
+                    pass
+            elif c in ('citations', 'refereed_citations'):
+                value = [strings.setdefault(b, b) for b in value]
+            values.append(value)
+        records.append(row_type(*values))
+    return records
+
+def get_summary_data(IDs):
+    SQL = "SELECT bibcode,refereed,author_num,citation_num,\
+           refereed_citation_num,reads_total,reads_recent,reads_length,\
+           downloads_total,downloads_recent,downloads_length \
+           FROM metrics_summary WHERE id = ANY (:ids) \
+           ORDER BY citation_num DESC"
+    results = execute_chunked_query(SQL, 'ids', IDs, ordered=True)
+    return results
+
+def refresh_metrics_summary(full=False):
+    """
+    Bring the metrics_summary table up to date with the metrics table: the
+    summaries of records modified since the last refresh (or of all records,
+    with full=True) are recomputed, and the summaries of records that no
+    longer exist are removed. Returns the number of updated summaries.
+    """
+    SQL = "INSERT INTO metrics_summary (id,bibcode,refereed,author_num,\
+           citation_num,refereed_citation_num,reads_total,reads_recent,\
+           reads_length,downloads_total,downloads_recent,downloads_length,\
+           modtime) \
+           SELECT id,bibcode,refereed,author_num,citation_num,\
+           refereed_citation_num,\
+           (SELECT coalesce(sum(r), 0) FROM unnest(reads) AS r),\
+           coalesce(reads[array_length(reads, 1)], 0),\
+           coalesce(array_length(reads, 1), 0),\
+           (SELECT coalesce(sum(d), 0) FROM unnest(downloads) AS d),\
+           coalesce(downloads[array_length(downloads, 1)], 0),\
+           coalesce(array_length(downloads, 1), 0),\
+           modtime FROM metrics"
+    if not full:
+        SQL += " WHERE modtime IS NULL OR modtime > \
+                (SELECT coalesce(max(modtime), '-infinity') FROM metrics_summary)"
+    SQL += " ON CONFLICT (id) DO UPDATE SET bibcode = EXCLUDED.bibcode,\
+            refereed = EXCLUDED.refereed, author_num = EXCLUDED.author_num,\
+            citation_num = EXCLUDED.citation_num,\
+            refereed_citation_num = EXCLUDED.refereed_citation_num,\
+            reads_total = EXCLUDED.reads_total,\
+            reads_recent = EXCLUDED.reads_recent,\
+            reads_length = EXCLUDED.reads_length,\
+            downloads_total = EXCLUDED.downloads_total,\
+            downloads_recent = EXCLUDED.downloads_recent,\
+            downloads_length = EXCLUDED.downloads_length,\
+            modtime = EXCLUDED.modtime"
+    with current_app.session_scope() as session:
+        updated = session.execute(text(SQL)).rowcount
+        session.execute(text("DELETE FROM metrics_summary s WHERE NOT EXISTS \
+                              (SELECT 1 FROM metrics m WHERE m.id = s.id)"))
+        session.commit()
+    return updated
+
+def get_modtime_summary(bibcodes):
+    """
+    A summary of the ids and modtimes of the records with these bibcodes
+    (as a hash), to check whether results computed from these records are
+    still valid. Records without a modtime cannot be checked, so then there
+    is no summary (None). With snapshots, the results are valid for as long
+    as the snapshot is used.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return (len(snapshot.rows_for_bibcodes(bibcodes)), snapshot.name)
+    SQL = "SELECT id,modtime FROM metrics WHERE bibcode = ANY (:bibcodes)"
+    results = execute_chunked_query(SQL, 'bibcodes', list(set(bibcodes)))
+    if any(r.modtime is None for r in results):
+        return None
+    summary = hashlib.sha1()
+    for id, modtime in sorted((r.id, r.modtime) for r in results):
+        summary.update(('%s %s\n' % (id, modtime.isoformat())).encode('utf-8'))
+    return summary.hexdigest()
+
+def get_bibcode_ids(bibcodes):
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.get_bibcode_ids(bibcodes)
+    SQL = "SELECT id,bibcode FROM bibcode_dictionary WHERE bibcode = ANY (:bibcodes)"
+    return execute_chunked_query(SQL, 'bibcodes', bibcodes)
+
+def get_dictionary_bibcodes(IDs):
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.get_dictionary_bibcodes(IDs)
+    SQL = "SELECT id,bibcode FROM bibcode_dictionary WHERE id = ANY (:ids)"
+    return execute_chunked_query(SQL, 'ids', IDs)
+
 def get_citations_single(bibcode):
-    SQL = "SELECT citations, refereed_citations, reads, downloads FROM metrics WHERE bibcode = '%s'" % bibcode
-    results = execute_SQL_query(SQL)
+    if current_app.config.get('METRICS_CITATION_YEARS', False):
+        columns = ['citation_years_start', 'refereed_citation_years',
+                   'nonrefereed_citation_years', 'reads', 'downloads']
+        results = get_single_record(bibcode, columns)
+        # The citations are needed when the counts are not there (yet)
+        if not results or results[0].refereed_citation_years is not None:
+            return results
+    if current_app.config.get('METRICS_CITATION_IDS', False) or \
+       get_snapshot() is not None:
+        columns = ['citation_ids', 'refereed_citation_ids', 'reads', 'downloads']
+        results = get_single_record(bibcode, columns)
+        if not results or results[0].citation_ids is not None:
+            return results
+    columns = ['citations', 'refereed_citations', 'reads', 'downloads']
+    return get_single_record(bibcode, columns)
+
+def get_single_record(bibcode, columns):
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.has_columns(columns):
+        return snapshot.get_record(bibcode, columns)
+    cache = getattr(current_app, 'row_cache', None)
+    if cache is not None:
+        return get_cached_records(cache, 'bibcode', [bibcode], columns)
+    SQL = "SELECT %s FROM metrics WHERE bibcode = :bibcode" % ", ".join(columns)
+    results = execute_SQL_query(SQL, {'bibcode': bibcode})
     return results
+
+def get_citation_records(bibcodes):
+    """
+    The citations, reads and downloads of the records with the given
+    bibcodes, by bibcode. The columns are chosen like in
+    get_citations_single, but the records are retrieved together (with
+    one chunked query per choice of columns).
+    """
+    records = {}
+    remaining = list(set(bibcodes))
+    if remaining and current_app.config.get('METRICS_CITATION_YEARS', False):
+        columns = ['bibcode', 'citation_years_start', 'refereed_citation_years',
+                   'nonrefereed_citation_years', 'reads', 'downloads']
+        results = get_bibcode_records(remaining, columns)
+        # The citations are needed when the counts are not there (yet)
+        remaining = [r.bibcode for r in results
+                     if r.refereed_citation_years is None]
+        records.update((r.bibcode, r) for r in results
+                       if r.refereed_citation_years is not None)
+    if remaining and (current_app.config.get('METRICS_CITATION_IDS', False) or
+                      get_snapshot() is not None):
+        columns = ['bibcode', 'citation_ids', 'refereed_citation_ids',
+                   'reads', 'downloads']
+        results = get_bibcode_records(remaining, columns)
+        remaining = [r.bibcode for r in results if r.citation_ids is None]
+        records.update((r.bibcode, r) for r in results
+                       if r.citation_ids is not None)
+    if remaining:
+        columns = ['bibcode', 'citations', 'refereed_citations', 'reads',
+                   'downloads']
+        records.update((r.bibcode, r) for r in
+                       get_bibcode_records(remaining, columns))
+    return records
+
+def get_bibcode_records(bibcodes, columns):
+    # Same as get_single_record, for a list of bibcodes
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.has_columns(columns):
+        return snapshot.get_bibcode_records(bibcodes, columns)
+    cache = getattr(current_app, 'row_cache', None)
+    if cache is not None:
+        return get_cached_records(cache, 'bibcode', bibcodes, columns)
+    SQL = "SELECT %s FROM metrics WHERE bibcode = ANY (:bibcodes)" % \
+          ", ".join(columns)
+    return execute_chunked_query(SQL, 'bibcodes', bibcodes)
+
+# Row types for records served from the row cache or a snapshot, by column
+# list
+row_types = {}
+
+def get_row_type(columns):
+    row_type = row_types.get(tuple(columns))
+    if row_type is None:
+        row_type = row_types[tuple(columns)] = namedtuple('MetricsRow', columns)
+    return row_type
+
+def get_cached_records(cache, key, values, columns):
+    """
+    Read the requested columns of the records with the given ids (key='id')
+    or bibcodes (key='bibcode') through the row cache. The modtimes of the
+    cached records are checked with one query; only the records that are
+    missing from the cache or have changed since are retrieved. Records
+    without a modtime cannot be checked, so they are not cached.
+    """
+    values = list(set(values))
+    cached = cache.lookup(key, values, columns)
+    records = []
+    if cached:
+        SQL = "SELECT id,modtime FROM metrics WHERE id = ANY (:ids)"
+        modtimes = dict((r.id, r.modtime) for r in
+                        execute_chunked_query(SQL, 'ids', [c['id'] for c in cached]))
+        for record in cached:
+            if record['modtime'] is not None and \
+               modtimes.get(record['id']) == record['modtime']:
+                records.append(record)
+            else:
+                cache.discard(record['id'])
+    found = set([r[key] for r in records])
+    missing = [v for v in values if v not in found]
+    if missing:
+        fields = ['id', 'bibcode', 'modtime']
+        fields += [c for c in columns if c not in fields]
+        SQL = "SELECT %s FROM metrics WHERE %s = ANY (:%s)" % \
+              (",".join(fields), key, key + 's')
+        for r in execute_chunked_query(SQL, key + 's', missing):
+            record = dict((f, getattr(r, f)) for f in fields)
+            if record['modtime'] is not None:
+                record = cache.put(record)
+            records.append(record)
+    row_type = get_row_type(columns)
+    return [row_type(*[r[c] for c in columns]) for r in records]
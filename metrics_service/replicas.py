@@ -0,0 +1,101 @@
+'''
+Routing of queries to read replicas
+
+Every query goes to the replica with the fewest queries in progress (taking
+turns between equally loaded replicas). When a query has not returned after
+hedge_delay seconds, the same query is sent to another replica as well, and
+the result that comes back first is used. A query that fails is tried again
+on another replica.
+'''
+from builtins import object
+from builtins import range
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+import threading
+from .models import execute_prepared_statement
+
+
+class ReplicaRouter(object):
+
+    def __init__(self, uris, hedge_delay=None, threads=16, pool_size=5):
+        self.uris = list(uris)
+        self.hedge_delay = hedge_delay
+        self.pool_size = pool_size
+        self.engines = [None] * len(self.uris)
+        # Number of queries in progress per replica
+        self.load = [0] * len(self.uris)
+        self.turn = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.hedged = 0
+
+    def engine(self, n):
+        with self.lock:
+            if self.engines[n] is None:
+                self.engines[n] = create_engine(self.uris[n],
+                                                pool_size=self.pool_size)
+            return self.engines[n]
+
+    def choose(self, exclude=()):
+        """
+        The least loaded replica that is not in exclude (None if there is
+        none), which is counted as loaded with one more query
+        """
+        with self.lock:
+            candidates = [n for n in range(len(self.uris)) if n not in exclude]
+            if not candidates:
+                return None
+            n = min(candidates, key=lambda n: (self.load[n],
+                                               (n - self.turn) % len(self.uris)))
+            self.turn = (n + 1) % len(self.uris)
+            self.load[n] += 1
+            return n
+
+    def run(self, n, query, params, prepared):
+        try:
+            with self.engine(n).connect() as connection:
+                if prepared:
+                    return execute_prepared_statement(connection, query, params)
+                return connection.execute(text(query), params).fetchall()
+        finally:
+            with self.lock:
+                self.load[n] -= 1
+
+    def execute(self, query, params, prepared=False):
+        attempts = []
+        tried = set()
+        error = None
+
+        def start():
+            n = self.choose(exclude=tried)
+            if n is None:
+                return False
+            tried.add(n)
+            attempts.append(self.executor.submit(self.run, n, query, params,
+                                                 prepared))
+            return True
+
+        start()
+        hedged = False
+        while attempts:
+            done, pending = wait(attempts, return_when=FIRST_COMPLETED,
+                                 timeout=None if hedged else self.hedge_delay)
+            if not done:
+                # The query is slow: send it to another replica as well
+                hedged = True
+                if start():
+                    self.hedged += 1
+                continue
+            for attempt in done:
+                attempts.remove(attempt)
+                if attempt.exception() is None:
+                    # The other attempt is abandoned (it only runs to
+                    # completion if it was started already)
+                    for other in attempts:
+                        other.cancel()
+                    return attempt.result()
+                error = attempt.exception()
+            if not attempts:
+                start()
+        raise error
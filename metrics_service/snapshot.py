@@ -0,0 +1,371 @@
+'''
+Columnar snapshots of the metrics table
+
+Usage: python -m metrics_service.snapshot [--directory DIRECTORY] [--keep N]
+
+A snapshot is a directory with the metrics records as flat binary columns,
+which are memory mapped when the snapshot is opened (so that the worker
+processes on a host share them):
+
+  - bibcode: the bibcodes (fixed width, sorted), which determine the order
+    of the records in all other columns
+  - id, refereed, author_num, citation_num, refereed_citation_num: one
+    value per record
+  - reads, downloads, citation_ids, refereed_citation_ids and the Tori
+    arrays: CSR-style, i.e. the values of all records (<column>.values),
+    the offset of the values of every record (<column>.offsets, with one
+    extra entry at the end) and whether the value is NULL (<column>.nulls)
+  - id_sorted, id_rows: the sorted ids and the records they belong to
+  - the bibcode dictionary (see codec.py) as dictionary_bibcode (sorted),
+    dictionary_id, dictionary_id_sorted and dictionary_id_rows
+
+The export command writes a new snapshot next to the current one and then
+points the 'current' symlink in the directory at it. Running applications
+(with METRICS_SNAPSHOT set to the directory) switch to the new snapshot
+with their next request. Run this periodically, e.g. right after the
+metrics table has been updated.
+'''
+from __future__ import absolute_import
+from builtins import object
+from datetime import datetime
+from flask import current_app
+from sqlalchemy.sql import text
+import argparse
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+from .models import get_row_type
+
+FORMAT = 1
+
+scalar_columns = [('id', 'i8'), ('refereed', '?'), ('author_num', 'i4'),
+                  ('citation_num', 'i4'), ('refereed_citation_num', 'i4')]
+array_columns = [('reads', 'i4'), ('downloads', 'i4'),
+                 ('citation_ids', 'i8'), ('refereed_citation_ids', 'i8'),
+                 ('tori_ids', 'i8'), ('tori_pubyears', 'i4'),
+                 ('tori_cityears', 'i4'), ('tori_weights', 'f8')]
+
+
+class ColumnWriter(object):
+
+    def __init__(self, path, dtype):
+        self.file = open(path, 'wb')
+        self.dtype = np.dtype(dtype)
+
+    def write(self, values):
+        np.asarray(values, dtype=self.dtype).tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+
+def write_column(path, values, dtype):
+    writer = ColumnWriter(path, dtype)
+    writer.write(values)
+    writer.close()
+
+
+def read_column(path, dtype):
+    # np.memmap cannot map empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def export_snapshot(directory, batch_size=10000, keep=2):
+    """
+    Write a snapshot of the metrics table (and the bibcode dictionary) to a
+    new subdirectory of directory, make it the current snapshot and remove
+    all but the keep most recent snapshots. The tables are read in one
+    REPEATABLE READ transaction, so that they are consistent. Returns the
+    path of the new snapshot.
+    """
+    name = 'snapshot-%s' % datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    path = os.path.join(directory, name)
+    tmp = path + '.tmp'
+    os.makedirs(tmp)
+    meta = {'format': FORMAT, 'created': datetime.utcnow().isoformat(),
+            'columns': dict(scalar_columns + array_columns)}
+    with current_app.session_scope() as session:
+        connection = session.connection(
+            execution_options={'isolation_level': 'REPEATABLE READ'})
+        width = connection.execute(text(
+            "SELECT max(octet_length(bibcode)) FROM metrics")).scalar() or 1
+        meta['records'] = export_records(connection, tmp, width, batch_size)
+        meta['bibcode_width'] = width
+        width = connection.execute(text(
+            "SELECT max(octet_length(bibcode)) FROM bibcode_dictionary")).scalar() or 1
+        meta['dictionary'] = export_dictionary(connection, tmp, width,
+                                               batch_size)
+        meta['dictionary_width'] = width
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp, path)
+    # Swap the symlink atomically (rename replaces the old link)
+    link = os.path.join(directory, 'current')
+    os.symlink(name, link + '.tmp')
+    os.rename(link + '.tmp', link)
+    # Applications may still be opening the previous snapshot, so that one
+    # is always kept
+    snapshots = sorted(d for d in os.listdir(directory)
+                       if d.startswith('snapshot-') and not d.endswith('.tmp'))
+    for old in snapshots[:-max(keep, 2)]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return path
+
+
+def export_records(connection, path, width, batch_size):
+    # The records are ordered by the bytes of the bibcodes, like numpy
+    # sorts them
+    SQL = "SELECT bibcode,%s FROM metrics ORDER BY bibcode COLLATE \"C\"" % \
+          ",".join(c for c, t in scalar_columns + array_columns)
+    bibcodes = ColumnWriter(os.path.join(path, 'bibcode'), 'S%s' % width)
+    scalars = dict((c, ColumnWriter(os.path.join(path, c), t))
+                   for c, t in scalar_columns)
+    values = dict((c, ColumnWriter(os.path.join(path, c + '.values'), t))
+                  for c, t in array_columns)
+    offsets = dict((c, ColumnWriter(os.path.join(path, c + '.offsets'), 'i8'))
+                   for c, t in array_columns)
+    nulls = dict((c, ColumnWriter(os.path.join(path, c + '.nulls'), '?'))
+                 for c, t in array_columns)
+    totals = dict((c, 0) for c, t in array_columns)
+    records = 0
+    results = connection.execution_options(stream_results=True).execute(text(SQL))
+    while True:
+        batch = results.fetchmany(batch_size)
+        if not batch:
+            break
+        records += len(batch)
+        bibcodes.write([r.bibcode.encode('utf-8') for r in batch])
+        for c, t in scalar_columns:
+            scalars[c].write([getattr(r, c) for r in batch])
+        for c, t in array_columns:
+            arrays = [getattr(r, c) for r in batch]
+            lengths = np.array([len(a or []) for a in arrays], dtype=np.int64)
+            offsets[c].write(totals[c] + np.cumsum(lengths) - lengths)
+            totals[c] += int(lengths.sum())
+            nulls[c].write([a is None for a in arrays])
+            values[c].write(list(itertools.chain(*[a for a in arrays if a])))
+    for c, t in array_columns:
+        offsets[c].write([totals[c]])
+    for writer in [bibcodes] + list(scalars.values()) + \
+            list(values.values()) + list(offsets.values()) + \
+            list(nulls.values()):
+        writer.close()
+    ids = read_column(os.path.join(path, 'id'), 'i8')
+    order = np.argsort(ids, kind='mergesort')
+    write_column(os.path.join(path, 'id_sorted'), ids[order], 'i8')
+    write_column(os.path.join(path, 'id_rows'), order, 'i8')
+    return records
+
+
+def export_dictionary(connection, path, width, batch_size):
+    SQL = "SELECT id,bibcode FROM bibcode_dictionary ORDER BY bibcode COLLATE \"C\""
+    bibcodes = ColumnWriter(os.path.join(path, 'dictionary_bibcode'), 'S%s' % width)
+    ids = ColumnWriter(os.path.join(path, 'dictionary_id'), 'i8')
+    entries = 0
+    results = connection.execution_options(stream_results=True).execute(text(SQL))
+    while True:
+        batch = results.fetchmany(batch_size)
+        if not batch:
+            break
+        entries += len(batch)
+        bibcodes.write([r.bibcode.encode('utf-8') for r in batch])
+        ids.write([r.id for r in batch])
+    bibcodes.close()
+    ids.close()
+    ids = read_column(os.path.join(path, 'dictionary_id'), 'i8')
+    order = np.argsort(ids, kind='mergesort')
+    write_column(os.path.join(path, 'dictionary_id_sorted'), ids[order], 'i8')
+    write_column(os.path.join(path, 'dictionary_id_rows'), order, 'i8')
+    return entries
+
+
+def find(keys, sorted_keys):
+    """
+    The positions of keys in the sorted array sorted_keys, and a mask of the
+    keys that were found
+    """
+    if len(keys) == 0 or len(sorted_keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    positions = np.searchsorted(sorted_keys, keys)
+    positions = np.minimum(positions, len(sorted_keys) - 1)
+    found = sorted_keys[positions] == keys
+    return positions[found], found
+
+
+class Snapshot(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != FORMAT:
+            raise ValueError('Unsupported snapshot format: %s' % self.meta['format'])
+        self.bibcodes = read_column(os.path.join(path, 'bibcode'),
+                                    'S%s' % self.meta['bibcode_width'])
+        self.columns = {}
+        for c, t in scalar_columns:
+            self.columns[c] = read_column(os.path.join(path, c), t)
+        self.arrays = {}
+        for c, t in array_columns:
+            self.arrays[c] = (read_column(os.path.join(path, c + '.values'), t),
+                              read_column(os.path.join(path, c + '.offsets'), 'i8'),
+                              read_column(os.path.join(path, c + '.nulls'), '?'))
+        self.id_sorted = read_column(os.path.join(path, 'id_sorted'), 'i8')
+        self.id_rows = read_column(os.path.join(path, 'id_rows'), 'i8')
+        self.dictionary_bibcodes = read_column(
+            os.path.join(path, 'dictionary_bibcode'),
+            'S%s' % self.meta['dictionary_width'])
+        self.dictionary_ids = read_column(os.path.join(path, 'dictionary_id'), 'i8')
+        self.dictionary_id_sorted = read_column(
+            os.path.join(path, 'dictionary_id_sorted'), 'i8')
+        self.dictionary_id_rows = read_column(
+            os.path.join(path, 'dictionary_id_rows'), 'i8')
+
+    def __len__(self):
+        return len(self.bibcodes)
+
+    def has_columns(self, columns):
+        return all(c == 'bibcode' or c in self.columns or c in self.arrays
+                   for c in columns)
+
+    def encode_bibcodes(self, bibcodes, width):
+        # Bibcodes longer than the column width cannot be in it (and would
+        # be truncated)
+        keys = [b.encode('utf-8') for b in set(bibcodes)]
+        return np.array([k for k in keys if len(k) <= width],
+                        dtype='S%s' % width)
+
+    def rows_for_bibcodes(self, bibcodes):
+        keys = self.encode_bibcodes(bibcodes, self.meta['bibcode_width'])
+        return find(keys, self.bibcodes)[0]
+
+    def rows_for_ids(self, IDs):
+        keys = np.unique(np.asarray(list(IDs), dtype=np.int64))
+        return self.id_rows[find(keys, self.id_sorted)[0]]
+
+    def ordered(self, rows):
+        # Most cited first, like the database queries (ties in the order of
+        # the bibcodes)
+        rows = np.sort(rows)
+        return rows[np.argsort(-self.columns['citation_num'][rows].astype(np.int64),
+                               kind='mergesort')]
+
+    def get_identifiers(self, bibcodes):
+        # Same as models.get_identifiers
+        rows = self.ordered(self.rows_for_bibcodes(bibcodes))
+        return list(zip(self.decode(self.bibcodes[rows]),
+                        self.columns['id'][rows].tolist(),
+                        self.columns['refereed'][rows].tolist()))
+
+    def get_records(self, IDs, columns):
+        # Same as models.get_metrics_data
+        rows = self.ordered(self.rows_for_ids(IDs))
+        return self.records(rows, columns)
+
+    def get_record(self, bibcode, columns):
+        return self.records(self.rows_for_bibcodes([bibcode]), columns)
+
+    def get_bibcode_records(self, bibcodes, columns):
+        # Same as models.get_bibcode_records
+        return self.records(self.rows_for_bibcodes(bibcodes), columns)
+
+    def records(self, rows, columns):
+        values = []
+        for c in columns:
+            if c == 'bibcode':
+                values.append(self.decode(self.bibcodes[rows]))
+            elif c in self.columns:
+                values.append(self.columns[c][rows].tolist())
+            else:
+                values.append(self.array_values(c, rows))
+        row_type = get_row_type(columns)
+        return [row_type(*v) for v in zip(*values)] if columns else []
+
+    def array_values(self, column, rows):
+        data, offsets, nulls = self.arrays[column]
+        starts = offsets[rows].tolist()
+        ends = offsets[rows + 1].tolist()
+        return [None if null else data[start:end].tolist() for start, end, null
+                in zip(starts, ends, nulls[rows].tolist())]
+
+    def get_bibcode_ids(self, bibcodes):
+        # Same as models.get_bibcode_ids
+        keys = self.encode_bibcodes(bibcodes, self.meta['dictionary_width'])
+        rows = find(keys, self.dictionary_bibcodes)[0]
+        return self.dictionary_rows(rows)
+
+    def get_dictionary_bibcodes(self, IDs):
+        # Same as models.get_dictionary_bibcodes
+        keys = np.unique(np.asarray(list(IDs), dtype=np.int64))
+        rows = self.dictionary_id_rows[find(keys, self.dictionary_id_sorted)[0]]
+        return self.dictionary_rows(rows)
+
+    def dictionary_rows(self, rows):
+        row_type = get_row_type(['id', 'bibcode'])
+        return [row_type(*r) for r in
+                zip(self.dictionary_ids[rows].tolist(),
+                    self.decode(self.dictionary_bibcodes[rows]))]
+
+    def decode(self, bibcodes):
+        return [b.decode('utf-8') for b in bibcodes.tolist()]
+
+
+class SnapshotStore(object):
+
+    """
+    The current snapshot in a directory, which is opened again when the
+    'current' symlink points to another snapshot
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.target = None
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        try:
+            target = os.readlink(os.path.join(self.directory, 'current'))
+        except OSError:
+            return self.snapshot
+        if target != self.target:
+            with self.lock:
+                if target != self.target:
+                    try:
+                        self.snapshot = Snapshot(
+                            os.path.join(self.directory, target))
+                        self.target = target
+                    except Exception as err:
+                        current_app.logger.error(
+                            'Unable to open metrics snapshot %s: %s' %
+                            (target, err))
+        return self.snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a snapshot of the metrics table')
+    parser.add_argument('--directory', default=None,
+                        help='snapshot directory (default: METRICS_SNAPSHOT)')
+    parser.add_argument('--keep', type=int, default=2,
+                        help='number of snapshots to keep')
+    args = parser.parse_args()
+    from .app import create_app
+    app = create_app()
+    directory = args.directory or app.config.get('METRICS_SNAPSHOT')
+    if not directory:
+        parser.error('no snapshot directory given')
+    stime = time.time()
+    with app.app_context():
+        path = export_snapshot(directory, keep=args.keep)
+        app.logger.info('Exported metrics snapshot %s in %s real seconds' %
+                        (path, time.time() - stime))
+
+if __name__ == '__main__':
+    main()
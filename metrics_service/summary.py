@@ -0,0 +1,30 @@
+'''
+Refresh the metrics_summary table
+
+Usage: python -m metrics_service.summary [--full]
+
+Run this periodically (e.g. right after the metrics table has been
+updated); only records modified since the last run are summarized again,
+unless --full is given.
+'''
+from __future__ import absolute_import
+import argparse
+import time
+from .app import create_app
+from .models import refresh_metrics_summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh the metrics summary table')
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='summarize all records again')
+    args = parser.parse_args()
+    app = create_app()
+    stime = time.time()
+    with app.app_context():
+        updated = refresh_metrics_summary(full=args.full)
+        app.logger.info('Refreshed %s metrics summaries in %s real seconds' %
+                        (updated, time.time() - stime))
+
+if __name__ == '__main__':
+    main()
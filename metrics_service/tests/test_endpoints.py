@@ -503,6 +503,9 @@ class TestEverythingBibcodes(TestCase):
         self.assertTrue(
             r.json['histograms'].keys(),
             ['publications', 'usage', 'citations'])
+        # All data should have been retrieved with just two queries:
+        # one for the identifiers and one for the metrics data
+        self.assertEqual(mock_execute_SQL_query.call_count, 2)
 
     @mock.patch('metrics_service.models.execute_SQL_query', return_value=testdata)
     def test_get_everything_bibcodes_no_tori(self, mock_execute_SQL_query):
@@ -586,6 +589,31 @@ class TestDetailReport(TestCase):
             data=json.dumps({'bibcodes': testset}))
         self.assertTrue(r.status_code == 200)
 
+    @mock.patch('metrics_service.models.execute_SQL_query', return_value=testdata)
+    def test_get_details_ndjson(self, mock_execute_SQL_query):
+        '''Test getting the details as newline delimited JSON'''
+        self.app.config['METRICS_DETAIL_BATCH_SIZE'] = 2
+        bibcodes = testset + ['2000foo...........']
+        expected = self.client.post(
+            url_for('detailmetrics'),
+            content_type='application/json',
+            data=json.dumps({'bibcodes': bibcodes})).json
+        r = self.client.post(
+            url_for('detailmetrics'),
+            content_type='application/json',
+            headers={'Accept': 'application/x-ndjson'},
+            data=json.dumps({'bibcodes': bibcodes}))
+        self.assertTrue(r.status_code == 200)
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        lines = [json.loads(l) for l in r.get_data(as_text=True).splitlines()]
+        # One line per record, and the skipped bibcodes last
+        self.assertEqual(list(lines[-1]), ['skipped bibcodes'])
+        self.assertTrue(all(len(l) == 1 for l in lines))
+        details = {}
+        for line in lines:
+            details.update(line)
+        self.assertEqual(details, expected)
+
 class TestMetricsSingleBibcode(TestCase):
 
     '''Check getting metrics for a single bibcode'''
@@ -613,5 +641,88 @@ class TestMetricsSingleBibcode(TestCase):
         # The histograms should consist of reads and citations
         self.assertEqual(list(r.json['histograms'].keys()), ['reads', 'citations'])
 
+
+class TestResultCache(TestCase):
+
+    '''Check that repeated metrics requests are served from the result cache'''
+
+    def create_app(self):
+        '''Create the wsgi application with a result cache'''
+        app_ = app.create_app(**{'METRICS_RESULT_CACHE_SIZE': 1000000,
+                                 'METRICS_RESULT_CACHE_TTL': 0})
+        return app_
+
+    def setUp(self):
+        self.modtimes = dict((r.id, datetime(2020, 1, 1)) for r in testdata)
+        self.queries = []
+
+    def fake_query(self, SQL, params):
+        from collections import namedtuple
+        self.queries.append(SQL)
+        if SQL.startswith('SELECT id,modtime') and 'bibcode' in SQL:
+            Row = namedtuple('Row', ['id', 'modtime'])
+            return [Row(id, modtime) for id, modtime in self.modtimes.items()]
+        return testdata
+
+    def post(self, bibcodes):
+        return self.client.post(
+            url_for('metrics'),
+            content_type='application/json',
+            data=json.dumps({'bibcodes': bibcodes, 'types': ['basic']}))
+
+    def test_result_cache(self):
+        '''Results should only be computed again when the records change'''
+        with mock.patch('metrics_service.models.execute_SQL_query',
+                        side_effect=self.fake_query):
+            r1 = self.post(testset)
+            self.assertEqual(len(self.queries), 3)
+            # The same bibcodes in a different order
+            r2 = self.post(list(reversed(testset)))
+            self.assertEqual(len(self.queries), 4)
+            self.assertEqual(r1.data, r2.data)
+            self.assertEqual(r2.json['basic stats']['number of papers'],
+                             len(testset))
+            self.modtimes[testdata[0].id] = datetime(2021, 1, 1)
+            r3 = self.post(testset)
+            self.assertEqual(len(self.queries), 7)
+            # A record that changes without changing the latest modtime
+            self.modtimes[testdata[1].id] = datetime(2019, 1, 1)
+            self.post(testset)
+            self.assertEqual(len(self.queries), 10)
+            self.post(testset)
+            self.assertEqual(len(self.queries), 11)
+        self.assertEqual(r3.json, r1.json)
+        self.assertEqual(len(self.app.result_cache), 1)
+
+    def test_result_cache_without_modtime(self):
+        '''Results from records without a modtime should not be cached'''
+        self.modtimes[testdata[0].id] = None
+        with mock.patch('metrics_service.models.execute_SQL_query',
+                        side_effect=self.fake_query):
+            r1 = self.post(testset)
+            self.assertEqual(len(self.queries), 3)
+            r2 = self.post(testset)
+            self.assertEqual(len(self.queries), 6)
+        self.assertEqual(r1.json, r2.json)
+        self.assertEqual(len(self.app.result_cache), 0)
+
+    def test_stale_results(self):
+        '''Stale results should be served while they are refreshed'''
+        from metrics_service.cache import ResultCache
+        cache = ResultCache(1000, 0, stale=True)
+        computed = []
+        def compute():
+            computed.append(1)
+            return 'result %s' % len(computed), True
+        self.assertEqual(cache.get('a', lambda: 1, compute), 'result 1')
+        self.assertEqual(cache.get('a', lambda: 1, compute), 'result 1')
+        self.assertEqual(cache.get('a', lambda: 2, compute), 'result 1')
+        for n in range(100):
+            if not cache.refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get('a', lambda: 2, compute), 'result 2')
+        self.assertEqual(len(computed), 2)
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -81,6 +81,62 @@ def get_test_data(bibcodes=None):
     return records
 
 
+def add_citation_years(records):
+    # Set the citation counts per year, the way the database trigger does
+    for r in records:
+        if r.refereed:
+            ref = [c for c in r.refereed_citations]
+            nonref = list(set(r.citations).difference(r.refereed_citations))
+        else:
+            ref = [c for c in r.citations if c in r.refereed_citations]
+            nonref = [c for c in r.citations if c not in r.refereed_citations]
+        ref = [int(c[:4]) for c in ref]
+        nonref = [int(c[:4]) for c in nonref]
+        if ref + nonref:
+            start = min(ref + nonref)
+            years = list(range(start, max(ref + nonref) + 1))
+        else:
+            start = None
+            years = []
+        r.citation_years_start = start
+        r.refereed_citation_years = [ref.count(y) for y in years]
+        r.nonrefereed_citation_years = [nonref.count(y) for y in years]
+    return records
+
+
+def add_citation_ids(records):
+    # Set the citations as bibcode identifiers, the way the database trigger
+    # does, and return the rows of the bibcode dictionary
+    from collections import namedtuple
+    from metrics_service.codec import YEAR_SHIFT
+    Row = namedtuple('Row', ['id', 'bibcode'])
+    dictionary = {}
+    for r in records:
+        for c in r.citations + r.refereed_citations:
+            if c not in dictionary:
+                dictionary[c] = (int(c[:4]) << YEAR_SHIFT) | len(dictionary)
+        r.citation_ids = [dictionary[c] for c in r.citations]
+        r.refereed_citation_ids = [dictionary[c] for c in r.refereed_citations]
+    return records, [Row(i, b) for b, i in dictionary.items()]
+
+
+def add_tori_arrays(records):
+    # Set the Tori arrays, the way the database trigger does, and return the
+    # rows of the bibcode dictionary
+    records, rows = add_citation_ids(records)
+    dictionary = dict((r.bibcode, r.id) for r in rows)
+    for r in records:
+        entries = r.rn_citation_data or []
+        for e in entries:
+            if e['bibcode'] not in dictionary:
+                dictionary[e['bibcode']] = len(dictionary)
+        r.tori_ids = [dictionary[e['bibcode']] for e in entries]
+        r.tori_pubyears = [e.get('pubyear', 0) for e in entries]
+        r.tori_cityears = [e['cityear'] for e in entries]
+        r.tori_weights = [e['auth_norm'] * e['ref_norm'] for e in entries]
+    return records, [rows[0]._make((i, b)) for b, i in dictionary.items()]
+
+
 class TestHelperFunctions(TestCase):
 
     '''Check if the helper functions return expected results'''
@@ -112,6 +168,45 @@ class TestHelperFunctions(TestCase):
         expected = {1990: 0, 1991: 1, 1992: 2, 1993: 3}
         self.assertEqual(merge_dictionaries(d1, d2), expected)
 
+    def test_get_columns(self):
+        '''Test the function that determines the columns to retrieve'''
+        from metrics_service.metrics import get_columns
+        base = ['bibcode', 'refereed', 'author_num', 'citation_num']
+        # Publication histograms only need the basic columns
+        self.assertEqual(
+            get_columns(['histograms'], histograms=['publications']), base)
+        # Indicators without Tori only need the citation counts and reads
+        self.assertEqual(
+            get_columns(['indicators'], tori=False), base + ['reads'])
+        # and with Tori the citations and Tori data are needed
+        self.assertEqual(
+            get_columns(['indicators'], tori=True),
+            base + ['reads', 'citations', 'rn_citation_data'])
+        # The downloads histograms consider the records with reads
+        self.assertEqual(
+            get_columns(['histograms'], histograms=['downloads']),
+            base + ['reads', 'downloads'])
+        # Citation stats do not need the refereed citations
+        self.assertEqual(
+            get_columns(['citations']),
+            base + ['refereed_citation_num', 'citations'])
+        # but the citation histograms do
+        self.assertEqual(
+            get_columns(['basic', 'histograms'], histograms=['citations']),
+            base + ['reads', 'downloads', 'citations', 'refereed_citations'])
+        # unless the citation counts per year can be used
+        self.assertEqual(
+            get_columns(['histograms'], histograms=['citations'],
+                        citation_years=True),
+            base + ['citation_years_start', 'refereed_citation_years',
+                    'nonrefereed_citation_years'])
+        # and the citations can be retrieved as bibcode identifiers
+        self.assertEqual(
+            get_columns(['citations', 'histograms'], histograms=['citations'],
+                        citation_ids=True),
+            base + ['refereed_citation_num', 'citation_ids',
+                    'refereed_citation_ids'])
+
     def test_encoder(self):
         '''Test if the encoder works properly'''
         from metrics_service.metrics import MyEncoder
@@ -166,6 +261,8 @@ class TestSelfCitationFunction(TestCase):
     def test_get_selfcitations(self, mock_execute_SQL_query):
         '''Test getting self-citations'''
         from metrics_service.metrics import get_selfcitations
+        from metrics_service.metrics import get_selfcitation_list
+        from metrics_service.metrics import CitationLists
         data, selfcits, Ns, Ns_r, Nc, Nc_r = get_selfcitations(
             [1, 2, 3], testset)
         # The 'data' returned is upposed to be a list of MetricsModel objects
@@ -173,15 +270,17 @@ class TestSelfCitationFunction(TestCase):
         self.assertTrue(
             False not in [x.__class__.__name__ == 'MetricsModel' for
                           x in data])
-        # The 'selfcits' returned is supposed to be a list to determine
-        # self-citation data it is a list of tuples with a 'set' as first
-        # element and a boolean as second
-        self.assertTrue(
-            False not in [isinstance(x[0], set) and isinstance(x[1], bool) for
-                          x in selfcits])
+        # The 'selfcits' returned has the citations of the records with
+        # the citing papers as integer codes, where the self-citations
+        # have the lowest codes
+        self.assertTrue(isinstance(selfcits, CitationLists))
+        self.assertEqual(len(selfcits.offsets), len(data) + 1)
+        self.assertEqual(len(selfcits.citing), selfcits.offsets[-1])
+        self.assertEqual(len(selfcits.papers), Nc)
+        self.assertEqual(sorted(selfcits.papers[:len(selfcits.self_citations)]),
+                         sorted(selfcits.self_citations))
         # Get the actual self-citations
-        selfs = list(itertools.chain(*[x[0]
-                                       for x in selfcits if len(x[0]) > 0]))
+        selfs = get_selfcitation_list(selfcits)
         self.assertEqual(
             sorted(selfs), sorted(expected_results['self-citations']))
         # Now check the number of self-citations
@@ -206,9 +305,34 @@ class TestSelfCitationFunction(TestCase):
     def test_get_selfcitations_invalid(self, mock_execute_SQL_query):
         '''Test getting self-citations'''
         from metrics_service.metrics import get_selfcitations
+        from metrics_service.metrics import get_selfcitation_list
         data, selfcits, Ns, Ns_r, Nc, Nc_r = get_selfcitations(
             [1, 2, 3], testset)
-        self.assertEqual(selfcits,[([], False)])
+        self.assertEqual(get_selfcitation_list(selfcits), [])
+        self.assertEqual((Ns, Ns_r, Nc, Nc_r), (0, 0, 0, 0))
+
+    def test_get_selfcitations_citation_ids(self):
+        '''The self-citations from bibcode identifiers should be the same'''
+        from metrics_service.metrics import get_selfcitations
+        from metrics_service.metrics import get_selfcitation_list
+        from metrics_service.metrics import get_selfcitation_ids
+        expected = get_selfcitations([1, 2, 3], testset,
+                                     data=get_test_data())[1:]
+        data, dictionary = add_citation_ids(get_test_data())
+        for p in data:
+            p.citations = p.refereed_citations = None
+        rows = [r for r in dictionary if r.bibcode in testset]
+        with mock.patch('metrics_service.codec.get_bibcode_ids',
+                        return_value=rows):
+            result = get_selfcitations([1, 2, 3], testset, data=data)[1:]
+            expected_ids = get_selfcitation_ids(expected[0])
+        self.assertEqual(result[1:], expected[1:])
+        self.assertEqual(sorted(get_selfcitation_list(result[0])),
+                         sorted(get_selfcitation_list(expected[0])))
+        # The self-citations are the same identifiers as when they are
+        # looked up in the bibcode dictionary
+        self.assertEqual(sorted(get_selfcitation_ids(result[0]).tolist()),
+                         sorted(expected_ids.tolist()))
 
 class TestBasicStatsFunction(TestCase):
 
@@ -274,6 +398,28 @@ class TestBasicStatsFunction(TestCase):
             False not in [x.__class__.__name__ == 'MetricsModel' for
                           x in data])
 
+    def test_get_summary_stats(self):
+        '''The basic stats from the summary table should be the same'''
+        from metrics_service.metrics import get_basic_stats, get_summary_stats
+        from metrics_service.models import MetricsSummaryModel
+        data = get_test_data(bibcodes=testset)
+        # Vary the usage, including records with incomplete usage
+        for n, p in enumerate(data):
+            p.reads = [n + i for i in range(len(p.reads))]
+            p.downloads = p.downloads[n:]
+        summary = [MetricsSummaryModel(
+            bibcode=p.bibcode,
+            refereed=p.refereed,
+            author_num=p.author_num,
+            reads_total=sum(p.reads),
+            reads_recent=p.reads[-1] if p.reads else 0,
+            reads_length=len(p.reads),
+            downloads_total=sum(p.downloads),
+            downloads_recent=p.downloads[-1] if p.downloads else 0,
+            downloads_length=len(p.downloads)) for p in data]
+        bs, bsr, data = get_basic_stats(testset, data=data)
+        self.assertEqual(get_summary_stats(testset, summary), (bs, bsr))
+
 
 class TestCitationStatsFunction(TestCase):
 
@@ -381,6 +527,28 @@ class TestToriFunction(TestCase):
         self.assertAlmostEqual(
             riq_ref, int(1000.0 * sqrt(tori_ref) / float(yrange)))
 
+    def test_get_tori_arrays(self):
+        '''The Tori from the Tori arrays should be the same'''
+        from metrics_service.metrics import get_selfcitations
+        from metrics_service.metrics import get_tori
+        from metrics_service.metrics import get_time_series
+        data = get_test_data()
+        selfcits = get_selfcitations([], testset, data=data)[1]
+        expected = get_tori(testset, testset, self_cits=selfcits, data=data)
+        expected_series = get_time_series(
+            testset, testset, data=data, usagedata=data,
+            tori_data=expected[4])
+        data, dictionary = add_tori_arrays(get_test_data())
+        for p in data:
+            p.rn_citation_data = None
+        with mock.patch('metrics_service.codec.get_bibcode_ids',
+                        return_value=dictionary):
+            result = get_tori(testset, testset, self_cits=selfcits, data=data)
+        self.assertEqual(result[:4], expected[:4])
+        series = get_time_series(testset, testset, data=data, usagedata=data,
+                                 tori_data=result[4])
+        self.assertEqual(series, expected_series)
+
 
 class TestPublicationHistogram(TestCase):
 
@@ -475,6 +643,53 @@ class TestUsageHistogram(TestCase):
             dhist['refereed downloads normalized'])
 
 
+    def test_usage_matrix(self):
+        '''Test the usage matrix of records with incomplete usage'''
+        from metrics_service.metrics import get_usage_matrix
+        from metrics_service.metrics import get_usage_histograms
+        data = get_test_data(bibcodes=testset)
+        # Records without usage for every year are left out
+        data[0].reads = data[0].reads[1:]
+        data[1].reads = None
+        matrix = get_usage_matrix(data, 'reads')
+        self.assertEqual(matrix.usage.shape, (len(data) - 2, len(data[2].reads)))
+        self.assertEqual(matrix.refereed.tolist(),
+                         [bool(p.refereed) for p in data[2:]])
+        self.assertEqual(matrix.authors.tolist(),
+                         [float(p.author_num) for p in data[2:]])
+        self.assertEqual(get_usage_histograms(testset, usage=matrix),
+                         get_usage_histograms(testset, data=data[2:]))
+        # Without any usage, the histograms are all zeros
+        hist = get_usage_histograms(testset, data=data[:2])
+        self.assertEqual(set(hist['all reads normalized'].values()), set([0]))
+
+
+    def test_usage_histograms_without_reads(self):
+        '''Without basic stats, only records with reads are usage data'''
+        from metrics_service.metrics import generate_metrics
+        from metrics_service.metrics import get_usage_histograms
+        data = get_test_data(bibcodes=testset)
+        data[0].reads = None
+        with mock.patch('metrics_service.models.execute_SQL_query',
+                        return_value=data):
+            results = generate_metrics(bibcodes=testset, types=['histograms'],
+                                       histograms=['reads', 'downloads'])
+        # The record without reads does not count for the downloads either
+        def expected(records):
+            return json.loads(json.dumps(get_usage_histograms(
+                testset, usage_type='downloads', data=records)))
+        self.assertEqual(results['histograms']['downloads'],
+                         expected(data[1:]))
+        self.assertNotEqual(results['histograms']['downloads'],
+                            expected(data))
+        # also when only the downloads histograms are requested
+        with mock.patch('metrics_service.models.execute_SQL_query',
+                        return_value=data):
+            results = generate_metrics(bibcodes=testset, types=['histograms'],
+                                       histograms=['downloads'])
+        self.assertEqual(results['histograms']['downloads'],
+                         expected(data[1:]))
+
 class TestCitationHistogram(TestCase):
 
     '''Check if the expected citation histogram is returned'''
@@ -514,6 +729,48 @@ class TestCitationHistogram(TestCase):
             self.assertEqual(nonzero, expected)
 
 
+    def test_citation_histograms_citation_years(self):
+        '''The histograms from the citation counts per year should be the same'''
+        from metrics_service.metrics import get_citation_histograms
+        expected = get_citation_histograms(
+            testset, data=get_test_data(bibcodes=testset))
+        data = add_citation_years(get_test_data(bibcodes=testset))
+        # The citations themselves should not be needed
+        for p in data:
+            p.citations = p.refereed_citations = None
+        self.assertEqual(get_citation_histograms(testset, data=data), expected)
+
+    def test_citation_histograms_citation_ids(self):
+        '''The histograms from bibcode identifiers should be the same'''
+        from metrics_service.metrics import get_citation_histograms
+        expected = get_citation_histograms(
+            testset, data=get_test_data(bibcodes=testset))
+        data = add_citation_ids(get_test_data(bibcodes=testset))[0]
+        for p in data:
+            p.citations = p.refereed_citations = None
+        self.assertEqual(get_citation_histograms(testset, data=data), expected)
+
+    def test_citation_categories(self):
+        '''Test the classification of citations with duplicates'''
+        from collections import namedtuple
+        from metrics_service.metrics import get_citation_categories
+        Record = namedtuple('Record', ['refereed', 'author_num', 'citations',
+                                       'refereed_citations'])
+        data = [Record(True, 2, ['2001a', '2002b', '2002b', '2003c'],
+                       ['2001a', '2004d']),
+                Record(False, 4, ['2001a', '2002b', '2002b', '2003c'],
+                       ['2002b'])]
+        rr, rn, nr, nn = get_citation_categories(data)
+        # The refereed citations of refereed records count, whether they are
+        # citations or not, and the other citations count once
+        self.assertEqual(rr[0].tolist(), [2001, 2004])
+        self.assertEqual(sorted(nr[0].tolist()), [2002, 2003])
+        self.assertEqual(rn[0].tolist(), [2002, 2002])
+        self.assertEqual(nn[0].tolist(), [2001, 2003])
+        self.assertEqual(rr[1].tolist(), [0.5, 0.5])
+        self.assertEqual(nn[1].tolist(), [0.25, 0.25])
+
+
 class TestTimeSeries(TestCase):
 
     '''Check if the expected time series are returned'''
@@ -551,5 +808,156 @@ class TestTimeSeries(TestCase):
             'False' not in [np.allclose([serie[y]],
                             expected[y]) for y in yrange])
 
+    def test_time_series_citation_years(self):
+        '''The time series from the citation counts per year should be the same'''
+        from metrics_service.metrics import get_time_series
+        data = get_test_data(bibcodes=testset)
+        expected = get_time_series(testset, testset, data=data, usagedata=data,
+                                   include_tori=False)
+        data = add_citation_years(get_test_data(bibcodes=testset))
+        for p in data:
+            p.citations = p.refereed_citations = None
+        self.assertEqual(get_time_series(testset, testset, data=data,
+                                         usagedata=data, include_tori=False),
+                         expected)
+
+    def test_read10_tori_series(self):
+        '''Test the read10 and Tori of all years at once'''
+        from metrics_service.metrics import get_read10_series
+        from metrics_service.metrics import get_tori_series
+        from metrics_service.metrics import UsageMatrix
+        from metrics_service.metrics import ToriData
+        Nentries = datetime.now().year - 1996 + 1
+        usage = UsageMatrix(
+            np.arange(2 * Nentries, dtype=np.int64).reshape(2, Nentries),
+            ['1998a', '2000b'], np.array([True, False]), np.array([2.0, 4.0]))
+        years = list(range(1995, 2010))
+        read10 = get_read10_series(usage, {'1998a': 1998, '2000b': 2000},
+                                   years)
+        self.assertEqual(read10[:4], [0.0, 0, 0, 1.0])
+        self.assertEqual(read10[5], 4 / 2.0 + (Nentries + 4) / 4.0)
+        # The first record is no longer included after ten years
+        self.assertEqual(read10[-2], (Nentries + 12) / 4.0)
+        # Records that are not among the bibcodes are left out
+        self.assertEqual(get_read10_series(usage, {'1998a': 1998}, years)[-1],
+                         0)
+        tori_data = ToriData(np.array([1990, 1996, 1996, 2001]),
+                             np.array([1999, 1996, 1998, 2002]),
+                             np.array([0.5, 0.25, 0.125, 1.0]))
+        self.assertEqual(get_tori_series(tori_data, years),
+                         [0.0, 0.25, 0.25, 0.375, 0.875, 0.875, 0.875] +
+                         [1.875] * 8)
+
+    def test_citation_index_series(self):
+        '''Test the indices from cumulative citations'''
+        from metrics_service.metrics import get_citation_index_series
+        # Three records with their citations up to three years; the last
+        # record is only included from the second year on
+        citations = np.array([[4, 12, 120], [1, 3, 11], [0, 0, 5]])
+        included = np.array([[True, True, True], [True, True, True],
+                             [False, True, True]])
+        h, g, i10, i100 = get_citation_index_series(citations, included)
+        self.assertEqual(h, [1, 2, 3])
+        # The g index counts the included records without citations as well
+        self.assertEqual(g, [2, 3, 3])
+        self.assertEqual(i10, [0, 1, 2])
+        self.assertEqual(i100, [0, 0, 1])
+
+class TestCitationReports(TestCase):
+
+    '''Check that the single citation reports of a list of records are the same'''
+
+    def create_app(self):
+        '''Create the wsgi application'''
+        app_ = app.create_app()
+        return app_
+
+    def test_citation_reports(self):
+        '''Test getting the reports from one retrieval of the records'''
+        from metrics_service.metrics import citation_reports
+        from metrics_service.metrics import single_citation_report
+        data = get_test_data(bibcodes=testset)
+        # A record without citations has no report
+        data[-1].citations = data[-1].refereed_citations = []
+        records = dict((r.bibcode, r) for r in data)
+        bibcodes = testset + ['2000foo...........']
+        expected = {}
+        skipped = []
+        for bibcode in bibcodes:
+            with mock.patch('metrics_service.metrics.get_citations_single',
+                            return_value=[records[bibcode]] if bibcode in records else []):
+                try:
+                    expected[bibcode] = single_citation_report(bibcode)
+                except:
+                    skipped.append(bibcode)
+        with mock.patch('metrics_service.metrics.get_citation_records',
+                        return_value=records) as mock_records:
+            reports, skip = citation_reports(bibcodes)
+        mock_records.assert_called_once_with(bibcodes)
+        self.assertEqual(reports, expected)
+        self.assertEqual(skip, skipped)
+        self.assertEqual(skip, [data[-1].bibcode, '2000foo...........'])
+
+    def test_report_histograms(self):
+        '''The histograms from the other forms of the citations should be the same'''
+        from metrics_service.metrics import report_histograms
+        data = get_test_data(bibcodes=testset)
+        bibcodes = [p.bibcode for p in data]
+        expected = report_histograms(bibcodes, data)
+        self.assertTrue(all(h is not None for h in expected))
+        for records in (add_citation_years(get_test_data(bibcodes=testset)),
+                        add_citation_ids(get_test_data(bibcodes=testset))[0]):
+            for p in records:
+                p.citations = p.refereed_citations = None
+            self.assertEqual(report_histograms(bibcodes, records), expected)
+        # Records without citations have no histograms
+        self.assertEqual(report_histograms(bibcodes[:1], [None]), [None])
+
+class TestCompactMetrics(TestCase):
+
+    '''Check that the compact records give the same results'''
+
+    testdata = get_test_data(bibcodes=testset)
+
+    def create_app(self):
+        '''Create the wsgi application (without the row cache)'''
+        app_ = app.create_app(**{'METRICS_ROW_CACHE_SIZE': 0})
+        return app_
+
+    def test_compact_metrics(self):
+        '''Test computing the metrics from compact records'''
+        from metrics_service.metrics import generate_metrics
+        types = ['basic', 'citations', 'histograms', 'indicators', 'timeseries']
+        histograms = ['publications', 'reads', 'downloads', 'citations']
+        with mock.patch('metrics_service.models.execute_SQL_query',
+                        return_value=self.testdata):
+            expected = generate_metrics(bibcodes=testset, types=types,
+                                        histograms=histograms, tori=True)
+        # Feed the records in batches of two, in a different order
+        batches = [self.testdata[3:], self.testdata[1:3], self.testdata[:1]]
+        self.app.config['METRICS_COMPACT_RECORDS'] = True
+        with mock.patch('metrics_service.models.execute_SQL_query',
+                        return_value=self.testdata), \
+             mock.patch('metrics_service.models.stream_SQL_query',
+                        return_value=iter(batches)) as mock_stream:
+            results = generate_metrics(bibcodes=testset, types=types,
+                                       histograms=histograms, tori=True)
+        self.app.config['METRICS_COMPACT_RECORDS'] = False
+        self.assertEqual(mock_stream.call_count, 1)
+        self.assertEqual(sorted(results.keys()), sorted(expected.keys()))
+        # The order of the self-citations depends on the order of the records
+        for r in [results, expected]:
+            r['citation stats']['self-citations'].sort()
+        # and floating point sums may differ in the last digits
+        def rounded(x):
+            if isinstance(x, dict):
+                return dict([(k, rounded(v)) for k, v in x.items()])
+            if isinstance(x, float):
+                return round(x, 10)
+            return x
+        for key in ['basic stats', 'citation stats', 'indicators',
+                    'indicators refereed', 'histograms', 'time series']:
+            self.assertEqual(rounded(results[key]), rounded(expected[key]))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
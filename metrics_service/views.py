@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 from builtins import map
-from flask import current_app, request
+from flask import current_app, request, stream_with_context
 from flask_restful import Resource
 from flask_discoverer import advertise
 from .metrics import generate_metrics
-from .metrics import single_citation_report
+from .metrics import citation_reports
+from .metrics import stream_citation_reports
+from .metrics import get_cached_metrics
 import time
 
 allowed_types = [
@@ -78,6 +80,20 @@ class Metrics(Resource):
         else:
             return {'Error': 'Unable to get results!',
                     'Error Info': 'Nothing to calculate metrics!'}, 403
+        cache = getattr(current_app, 'result_cache', None)
+        if cache is not None:
+            # The cached results are JSON already, so they are sent as is
+            results = get_cached_metrics(
+                cache, bibcodes=bibcodes, query=query, tori=include_tori,
+                types=types, histograms=histograms)
+            if results:
+                duration = time.time() - stime
+                current_app.logger.info('Metrics request successfully completed in %s real seconds'%duration)
+                return current_app.response_class(
+                    results, mimetype='application/json')
+            current_app.logger.info('Metrics request returned empty result')
+            return {'Error': 'Unable to get results!',
+                    'Error Info': 'No data available to generate metrics'}, 200
         results = generate_metrics(
             bibcodes=bibcodes, query=query, tori=include_tori,
             types=types, histograms=histograms)
@@ -142,13 +158,15 @@ class DetailMetrics(Resource):
                      bibcodes exceeds maximum number'}, 403
         current_app.logger.info('Individual metrics requested for %s bibcodes'%len(bibcodes))
         stime = time.time()
-        for bibcode in bibcodes:
-            try:
-                citdata = single_citation_report(bibcode)
-                details[bibcode] = citdata
-            except:
-                details['skipped bibcodes'].append(bibcode)
-                continue
+        if request.accept_mimetypes.best_match(
+                ['application/json', 'application/x-ndjson']) == 'application/x-ndjson':
+            batch_size = current_app.config.get('METRICS_DETAIL_BATCH_SIZE', 500)
+            return current_app.response_class(
+                stream_with_context(stream_citation_reports(bibcodes, batch_size)),
+                mimetype='application/x-ndjson')
+        reports, skipped = citation_reports(bibcodes)
+        details.update(reports)
+        details['skipped bibcodes'] = skipped
         # otherwise we have real results or an empty dictionary
         if details:
             duration = time.time() - stime